@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Benchmarks for claspy.  Builds scaled-up versions of the example
+# puzzles and reports how long it takes to construct and encode them.
+
+import sys
+import time as timer
+import claspy
+from claspy import *
+
+class Sink(object):
+    """A stream that discards its input, recording when the first
+    byte arrives and how much was written."""
+    def __init__(self):
+        self.first_write = None
+        self.num_writes = 0
+        self.num_bytes = 0
+    def write(self, s):
+        if self.first_write is None:
+            self.first_write = timer.time()
+        self.num_writes += 1
+        self.num_bytes += len(s)
+
+def latin_square(n):
+    grid = [[IntVar(1,n) for c in range(n)] for r in range(n)]
+    for r in range(n):
+        require_all_diff(grid[r])
+    for c in range(n):
+        require_all_diff([grid[r][c] for r in range(n)])
+
+def hitori(n):
+    fill_grid = [[BoolVar() for c in range(n)] for r in range(n)]
+    conn_grid = [[Atom() for c in range(n)] for r in range(n)]
+    conn_grid[0][0].prove_if(True)
+    for r in range(n):
+        for c in range(n):
+            if r+1 < n: require(~(fill_grid[r][c] & fill_grid[r+1][c]))
+            if c+1 < n: require(~(fill_grid[r][c] & fill_grid[r][c+1]))
+            for r1,c1 in [(r,c-1),(r,c+1),(r-1,c),(r+1,c)]:
+                if r1 >= 0 and r1 < n and c1 >= 0 and c1 < n:
+                    conn_grid[r][c].prove_if(conn_grid[r1][c1] & ~fill_grid[r1][c1])
+            require(conn_grid[r][c] | fill_grid[r][c])
+        require(at_most(n // 3, fill_grid[r]))
+
+def adders(n):
+    xs = [IntVar() for i in range(n)]
+    require(sum_vars(xs) == 1000)
+    for i in range(n // 4):
+        require(xs[i] * xs[i+1] > 3)
+
+benchmarks = [('latin square 25x25', latin_square, 25),
+              ('hitori 150x150', hitori, 150),
+              ('adders 200', adders, 200)]
+
+for name, build, size in benchmarks:
+    reset()
+    start = timer.time()
+    build(size)
+    built = timer.time()
+    sink = Sink()
+    claspy.write_program(sink)
+    done = timer.time()
+    print '%-20s %8d rules  build %6.2fs  first byte %6.3fs  serialize %6.3fs  %5.1fMB in %d writes' % (
+        name, len(claspy.rule_starts), built - start, sink.first_write - built,
+        done - built, sink.num_bytes / 1e6, sink.num_writes)
+    sys.stdout.flush()
@@ -24,11 +24,17 @@
 # IntVar() : Create a non-negative integer variable.
 # IntVar(1,9) : Integer variable in range 1-9, inclusive.
 # IntVar([1,2,3]) : Integer variable with one of the given values.
+# DirectIntVar(1,9) : Integer variable with one boolean per value.
+# OrderIntVar(1,9) : Integer variable with one boolean per bound x >= v.
 # MultiVar('a','b') : Generalized variable with one of the given values.
 # Atom() : An atom is only true if it is proven, with Atom.prove_if(<b>).
 # cond(<pred>, <cons>, <alt>) : Create an "if" statement.
 # require(<expr>) : Constrain a variable or expression to be true.
 # solve() : Runs clasp and returns True if satisfiable.
+# iter_solutions() : Generates every solution from a single run of clasp.
+# count_solutions(limit=2) : Counts solutions, e.g. to check uniqueness.
+# forced_values(<vars>) : The values the variables have in every solution.
+# possible_values(<vars>) : The values the variables have in some solution.
 #
 # After running solve, print the variables or call var.value() to get
 # the result.
@@ -36,15 +42,41 @@
 ## Additional functions ##
 #
 # reset() : Resets the system.  Do not use any old variables after reset.
-# set_bits(8) : Set the number of bits for integer variables.
-#               Must be called before any variables are created.
-# set_max_val(100) : Set the max number of bits as necessary for the given value.
-#                    Must be called before any variables are created.
+# set_incremental() : Keep the encoded program and clasp's learned lemmas
+#                     between calls to solve().
+# set_simplify() : Simplify the whole program before giving it to clasp.
+# set_streaming() : Write rules to clasp as they are created.
+# solve(threads=N, mode='split') : Solve with several clasp threads.
+# solve(configs=[<options>, ...]) : Race clasps with different options.
+# solve(assume=[<expr>, ...]) : Solve with the expressions required, for
+#   this call only.
+# solve(timeout=10) : Stop clasp after 10 seconds, and return TIMEOUT.
+# solve_async() : Start clasp and return a SolveRun without waiting.
+# solve_stats : The phase timings and clasp statistics of the last solve.
+# with Model(): ... : Build and solve a separate model, e.g. in a thread.
+# solve_many(builder, instances) : Solve many instances in worker processes.
+# save_program(file, vars), load_program(file) : Save the rules and
+#   variables of a model to a file, and load them without rebuilding it.
+# cached_program(builder, args) : Build a model once, and load it after.
+# set_bits(8) : Set the default number of bits for integer variables.
+# set_max_val(100) : Set the default number of bits as necessary for the
+#                    given value.
 # require_all_diff(lst) : Constrain all vars in a list to be different.
 # sum_vars(lst) : Convenience function to sum a list of variables.
+# linear_ge(coeffs, vars, k) : Whether the sum of coeffs[i] * vars[i] is
+#   at least k, as one weight rule.  Also linear_le and linear_eq.
 # at_least(n, bools) : Whether at least n of the booleans are true.
 # at_most(n, bools) : Whether at most n of the booleans are true.
 # sum_bools(n, bools) : Whether exactly n of the booleans are true.
+# count(bools) : The number of true booleans, as an OrderIntVar.
+# all_of(bools) : Whether all of the booleans are true, as one rule.
+# any_of(bools) : Whether any of the booleans are true.
+# minimize(<expr>), maximize(<expr>) : Make solve() find an optimal solution.
+# objective_values() : The values of the objectives in the solution.
+# values(<vars>) : The solution values of a nested list of variables,
+#   decoded together.  values(<vars>, as_array=True) returns a NumPy array.
+# show(<vars>) : Name the variables' literals in the solution, so that their
+#   values don't need to be computed from the rules.
 # required(<expr>, <str>) : Print the debug string if the expression
 #   is false.  You can change a 'require' statement to 'required' for debugging.
 # var_in(v, lst) : Whether var v is equal to some element in lst.
@@ -60,11 +92,40 @@
 # Subtracting from an IntVar requires that the result is positive,
 # so you usually want to add to the other side of the equation instead.
 
+import atexit
+from array import array
+import cPickle
+from cStringIO import StringIO
+import hashlib
+from itertools import compress
+import mmap
+import multiprocessing
+import os
+import Queue
+import re
+import resource
+import shutil
+import stat
+import struct
 import subprocess
-from time import time, strftime
+import sys
+import tempfile
+import threading
+from time import sleep, strftime, time
+import weakref
+
+try:
+    import numpy  # optional, for values(as_array=True)
+except ImportError:
+    numpy = None
 
 CLASP_COMMAND = 'clasp --sat-prepro --eq=1 --trans-ext=dynamic'
 
+# Options for logging learned lemmas in incremental mode (clasp 3.3+).
+# Only short lemmas (low lbd) are kept, and at most MAX_LEMMAS in total.
+LEMMA_OPTIONS = '--lemma-out-dom=input --lemma-out-lbd=4 --lemma-out-max=20000'
+MAX_LEMMAS = 100000
+
 
 ################################################################################
 ###############################  Infrastructure  ###############################
@@ -93,7 +154,7 @@ def hash_object(x):
     else:
         return x
 
-memo_caches = []  # a reference to all memoization dictionaries, to allow reset
+memo_caches = []  # all memoized functions, to allow reset
 class memoized(object):
     """Decorator that caches a function's return value.  Based on:
     http://wiki.python.org/moin/PythonDecoratorLibrary#Memoize"""
@@ -101,8 +162,9 @@ class memoized(object):
         global memo_caches
         self.func = func
         self.cache = {}
-        memo_caches.append(self.cache)
+        memo_caches.append(self)
     def __call__(self, *args):
+        if active_model is not None: check_thread()
         try:
             key = tuple(map(hash_object, args))
             return self.cache[key]
@@ -125,6 +187,7 @@ class memoized_symmetric(memoized):
     """Decorator that memoizes a function where the order of the
     arguments doesn't matter."""
     def __call__(self, *args):
+        if active_model is not None: check_thread()
         try:
             key = tuple(sorted(map(hash_object, args)))
             return self.cache[key]
@@ -147,33 +210,69 @@ FALSE_BOOL = None
 def reset():
     """Reset the solver.  Any variables defined before a reset will
     have bogus values and should not be used."""
-    global last_bool, TRUE_BOOL, FALSE_BOOL, solution
-    global memo_caches, debug_constraints, clasp_rules
-    global single_vars, NUM_BITS, BITS
+    global last_bool, TRUE_BOOL, FALSE_BOOL
+    global memo_caches, debug_constraints, clasp_rules, rule_starts
+    global single_vars, NUM_BITS, BITS, visible, rule_index, num_indexed
+    global tight, gates, gate_inputs, saved_literals, saved_rules, objectives
+    global build_start
 
     NUM_BITS = 16
     BITS = range(NUM_BITS)
 
-    clasp_rules = []
+    clasp_rules = array('i')
+    rule_starts = array('l')
     single_vars = set()
     last_bool = 1  # reserved in clasp
+    visible = bytearray(2)
+    tight = bytearray(2)
+    reset_stream()
+    gates = {}
+    gate_inputs = {}
+    saved_literals = 0
+    saved_rules = 0
+    rule_index = {}
+    num_indexed = 0
+    objectives = []
+    build_start = time()
+    reset_session()
 
     TRUE_BOOL = BoolVar()
     require(TRUE_BOOL)
     FALSE_BOOL = ~TRUE_BOOL
-    solution = set([TRUE_BOOL.index])
+    initial = bytearray(TRUE_BOOL.index + 1)
+    initial[TRUE_BOOL.index] = 1
+    set_solution(initial, bytearray([1]) * len(initial))
 
-    for cache in memo_caches:
-        cache.clear()
+    for m in memo_caches:
+        m.cache = {}
     debug_constraints = []
 
 last_bool = None  # used to set the indexes of BoolVars
 def new_literal():
     """Returns the number of a new literal."""
+    if active_model is not None: check_thread()
     global last_bool
     last_bool += 1
+    visible.append(0)
+    tight.append(0)
     return last_bool
 
+# Only visible literals are named in the program given to clasp, so
+# only their values are printed in the solution.  These are the
+# literals of variables created by the user, such as BoolVar() and
+# Atom(), plus those passed to show().  The values of other literals
+# are computed when needed from the rules that define them.
+visible = None  # visible[i] is 1 if literal i is visible
+def show(*args):
+    """Names the literals of the given variables in the solution, so
+    that their values are read directly from clasp."""
+    for i in var_literals(list(args)):
+        visible[i] = 1
+
+def visible_literals():
+    """Returns a list of all visible literals."""
+    return list(compress(xrange(len(visible)), visible))
+
 def require(x, ignored=None):
     """Constrains the variable x to be true.  The second argument is
     ignored, for compatibility with required()."""
@@ -189,14 +288,33 @@ def required(x, debug_str):
     global debug_constraints
     debug_constraints.append((x,debug_str))
 
+# All rules are stored in one flat array of integers, rather than a
+# list per rule, to save memory.  rule_starts has the position of the
+# first integer of each rule.
 clasp_rules = None
+rule_starts = None
 def add_rule(vals):
     """The rule is encoded as a series of integers, according to the
     SMODELS internal format.  See lparse.pdf pp.86 (pdf p.90)."""
-    global clasp_rules
-    clasp_rules.append(vals)
+    if active_model is not None: check_thread()
+    rule_starts.append(len(clasp_rules))
+    clasp_rules.extend(vals)
+    if session_lemmas and redefines_solved_atom(vals):
+        discard_lemmas()
+    if stream is not None and len(rule_starts) >= ENCODE_CHUNK:
+        flush_stream()
     if need_update():
-        print len(clasp_rules), 'rules'
+        print num_rules(), 'rules'
+
+def num_rules():
+    """Returns the number of rules, including those already streamed."""
+    return num_streamed + len(rule_starts)
+
+def get_rule(i):
+    """Returns the integers of rule number i, as an array."""
+    if i + 1 < len(rule_starts):
+        return clasp_rules[rule_starts[i]:rule_starts[i+1]]
+    return clasp_rules[rule_starts[i]:]
 
 def lit2str(literals):
     """For debugging, formats the given literals as a string matching
@@ -222,11 +340,13 @@ def add_basic_rule(head, literals):
     if verbose:
         if len(literals) == 0: print '#opt', head2str(head) + '.'
         else: print '#opt', head2str(head), ':-', lit2str(literals) + '.'
+    add_rule(basic_rule_vals(head, literals))
+
+def basic_rule_vals(head, literals):
     # format: 1 head #literals #negative [negative] [positive]
-    negative_literals = map(abs, filter(lambda x: x < 0, literals))
-    positive_literals = filter(lambda x: x > 0, literals)
-    add_rule([1, head, len(literals), len(negative_literals)] +
-             negative_literals + positive_literals)
+    negative_literals = [-x for x in literals if x < 0]
+    return ([1, head, len(literals), len(negative_literals)] +
+            negative_literals + [x for x in literals if x > 0])
 
 def add_choice_rule(heads, literals):
     if verbose:
@@ -236,36 +356,46 @@ def add_choice_rule(heads, literals):
             print '{', lit2str(heads), '} :-', lit2str(literals)
     for i in heads:
         assert i > 0
+    add_rule(choice_rule_vals(heads, literals))
+
+def choice_rule_vals(heads, literals):
     # format: 3 #heads [heads] #literals #negative [negative] [positive]
-    negative_literals = map(abs, filter(lambda x: x < 0, literals))
-    positive_literals = filter(lambda x: x > 0, literals)
-    add_rule([3, len(heads)] + heads +
-             [len(literals), len(negative_literals)] +
-             negative_literals + positive_literals)
+    negative_literals = [-x for x in literals if x < 0]
+    return ([3, len(heads)] + heads +
+            [len(literals), len(negative_literals)] +
+            negative_literals + [x for x in literals if x > 0])
 
 def add_constraint_rule(head, bound, literals):
     # Note that constraint rules ignore repeated literals
     if verbose:
         print head2str(head), ':-', bound, '{', lit2str(literals), '}.'
     assert head > 0
+    add_rule(constraint_rule_vals(head, bound, literals))
+
+def constraint_rule_vals(head, bound, literals):
     # format: 2 head #literals #negative bound [negative] [positive]
-    negative_literals = map(abs, filter(lambda x: x < 0, literals))
-    positive_literals = filter(lambda x: x > 0, literals)
-    add_rule([2, head, len(literals), len(negative_literals), bound] +
-             negative_literals + positive_literals)
+    negative_literals = [-x for x in literals if x < 0]
+    return ([2, head, len(literals), len(negative_literals), bound] +
+            negative_literals + [x for x in literals if x > 0])
 
-def add_weight_rule(head, bound, literals):
+def add_weight_rule(head, bound, literals, weights=None):
     # Unlike constraint rules, weight rules count repeated literals
+    if weights is None:
+        weights = [1] * len(literals)
     if verbose:
         print head2str(head), ':-', bound, '[',
-        print ', '.join(map(lambda x: x + '=1', lit2str(literals).split(', '))), '].'
+        print ', '.join(map(lambda x, w: x + '=' + str(w),
+                            lit2str(literals).split(', '), weights)), '].'
     assert head > 0
+    add_rule(weight_rule_vals(head, bound, literals, weights))
+
+def weight_rule_vals(head, bound, literals, weights):
     # format: 5 head bound #literals #negative [negative] [positive] [weights]
-    negative_literals = map(abs, filter(lambda x: x < 0, literals))
-    positive_literals = filter(lambda x: x > 0, literals)
-    weights = [1 for i in range(len(literals))]
-    add_rule([5, head, bound, len(literals), len(negative_literals)] +
-             negative_literals + positive_literals + weights)
+    negative = [(-x, w) for x, w in zip(literals, weights) if x < 0]
+    positive = [(x, w) for x, w in zip(literals, weights) if x > 0]
+    return ([5, head, bound, len(literals), len(negative)] +
+            [x for x, w in negative] + [x for x, w in positive] +
+            [w for x, w in negative] + [w for x, w in positive])
 
 single_vars = None
 def optimize_basic_rule(head, literals):
@@ -288,68 +418,1894 @@ def optimize_basic_rule(head, literals):
                 return optimize_basic_rule(head, new_literals)
     return literals
 
-start_time = time()  # time when the library is loaded
-solution = None  # set containing indices of true variables
-def solve():
-    """Solves for all defined variables.  If satisfiable, returns True
-    and stores the solution so that variables can print out their
-    values."""
-    global last_bool, solution, debug_constraints, last_update
+################################################################################
+##################################  Encoding  ##################################
+################################################################################
+
+# The program is written to clasp in large chunks of text.  Each chunk
+# is encoded from the flat rule array with a single join, and newlines
+# are only added at the end of each rule.
+
+ENCODE_CHUNK = 1 << 16  # number of rules or symbols encoded at once
+
+def encode_rules(first=0, rules=None, starts=None):
+    """Generates the text of all rules from rule number first on, in
+    chunks of ENCODE_CHUNK rules.  The rules are clasp_rules, unless
+    another array of rules and their starts is given."""
+    if rules is None:
+        rules, starts = clasp_rules, rule_starts
+    num_rules = len(starts)
+    for i in xrange(first, num_rules, ENCODE_CHUNK):
+        j = min(i + ENCODE_CHUNK, num_rules)
+        start = starts[i]
+        end = starts[j] if j < num_rules else len(rules)
+        strs = map(str, rules[start:end])
+        for k in starts[i+1:j]:  # the last number of each rule
+            strs[k - start - 1] += '\n'
+        strs[-1] += '\n'
+        yield ' '.join(strs)
+
+def encode_symbols(show, names=None):
+    """Generates the text of the symbol table naming the literals in
+    show, in chunks of ENCODE_CHUNK symbols.  Each literal x is named
+    'v' + names[x], which is x by default."""
+    for i in xrange(0, len(show), ENCODE_CHUNK):
+        if names is None:
+            yield ''.join(['%d v%d\n' % (x, x) for x in show[i:i+ENCODE_CHUNK]])
+        else:
+            yield ''.join(['%d v%d\n' % (x, names[x]) for x in show[i:i+ENCODE_CHUNK]])
+
+def compute_statement(assume=()):
+    """Returns the end of the symbols, and the compute statement,
+    which requires the literals in assume to be true."""
+    true_atoms = [x for x in assume if x > 0]
+    false_atoms = [1] + [-x for x in assume if x < 0]
+    return '0\nB+\n%s0\nB-\n%s0\n1\n' % (''.join(['%d\n' % x for x in true_atoms]),
+                                           ''.join(['%d\n' % x for x in false_atoms]))
+
+def write_program(stream, show=None, assume=(), extra=''):
+    """Writes the program in SMODELS format to stream.  Only the
+    literals in show are named, which are the visible literals by
+    default.  The literals in assume are required to be true by the
+    compute statement, without changing the rules.  The text of extra
+    rules, which aren't kept in the program, is written after them."""
+    if show is None:
+        show = visible_literals()
+    names = None
+    if simplify and not incremental and not assume and not objectives and not extra:
+        rules, starts, show, names = simplify_program(show)
+        chunks = encode_rules(0, rules, starts)
+    else:
+        chunks = program_rules()
+    for chunk in chunks:
+        stream.write(chunk)
+    stream.write(extra)
+    stream.write(minimize_statements())
+    stream.write('0\n')  # end of rules
+    for chunk in encode_symbols(show, names):
+        stream.write(chunk)
+    stream.write(compute_statement(assume))
+
+
+################################################################################
+###############################  Simplification  ###############################
+################################################################################
+
+# The optional simplification pass rewrites the whole program before
+# it is written to clasp.  Facts, and atoms without any rules, are
+# propagated through the bodies of rules.  Constraints on a single
+# literal are propagated too, but only where they don't change which
+# atoms are founded: a required atom is only removed from negative
+# literals.  Then only the rules defining atoms which are reachable
+# from constraints and named literals are kept, identical rules are
+# written once, and the atoms are numbered densely.  Atoms are named
+# with their original numbers, so answers are read as usual.
+#
+# Incremental mode doesn't simplify, since the lemmas it keeps refer
+# to the original numbers of the atoms.
+
+simplify = False
+def set_simplify(b=True):
+    """Set simplification of the whole program before solving."""
+    global simplify
+    simplify = b
+
+simplify_stats = None  # dictionary of what the last simplification removed
+
+def parse_rule(i):
+    """Returns rule number i as a list [type, heads, literals, bound,
+    weights].  Basic and choice rules have no bound or weights, and
+    constraint rules are returned as weight rules."""
+    rule = get_rule(i)
+    if rule[0] == 3:  # 3 #heads [heads] #literals #negative [negative] [positive]
+        k = 2 + rule[1]
+        n, neg = rule[k], rule[k+1]
+        literals = [-x for x in rule[k+2:k+2+neg]] + list(rule[k+2+neg:k+2+n])
+        return [3, list(rule[2:k]), literals, None, None]
+    literals, bound, weights = rule_body(i)
+    if rule[0] == 1:
+        return [1, [rule[1]], literals, None, None]
+    return [5, [rule[1]], literals, bound, weights or [1] * len(literals)]
+
+def rule_vals(rule):
+    """Returns the integers of a rule given as by parse_rule."""
+    kind, heads, literals, bound, weights = rule
+    if kind == 1:
+        return basic_rule_vals(heads[0], literals)
+    if kind == 3:
+        return choice_rule_vals(heads, literals)
+    if set(weights) == set([1]) and len(set(literals)) == len(literals):
+        return constraint_rule_vals(heads[0], bound, literals)
+    return weight_rule_vals(heads[0], bound, literals, weights)
+
+def simplify_program(show):
+    """Returns the simplified program as an array of rules, the starts
+    of the rules, the atoms to name and a dictionary from each atom to
+    its original number."""
+    global simplify_stats
+    rules = [parse_rule(i) for i in xrange(len(rule_starts))]
+    facts = set()
+    undefined = set()  # atoms without rules, which are false
+    required_true = set()
+    required_false = set()
+    stats = {'satisfied': 0, 'unreachable': 0, 'duplicate': 0}
+    def known(l):
+        """Returns the value of literal l if it can be removed from
+        bodies, or None."""
+        a = abs(l)
+        if a in facts: return l > 0
+        if a in undefined or a in required_false: return l < 0
+        if a in required_true and l < 0: return False
+        return None
+    num_defs = {}  # dictionary from atom to the number of rules defining it
+    occurs = {}  # dictionary from atom to the rules it occurs in
+    free = set()  # heads of choice rules without a body
+    for i, rule in enumerate(rules):
+        for h in rule[1]:
+            num_defs[h] = num_defs.get(h, 0) + 1
+            occurs.setdefault(h, []).append(i)
+        for l in rule[2]:
+            occurs.setdefault(abs(l), []).append(i)
+    undefined.update([a for a in occurs if a not in num_defs and a != 1])
+    changed = set()  # atoms which have become known
+    def remove_rule(i):
+        for h in rules[i][1]:
+            num_defs[h] -= 1
+            if num_defs[h] == 0 and h not in facts:
+                undefined.add(h)
+                changed.add(h)
+        rules[i] = None
+    pending = xrange(len(rules))  # rules to simplify
+    while pending:
+        for i in pending:
+            if rules[i] is None:
+                continue
+            kind, heads, literals, bound, weights = rules[i]
+            heads = [h for h in heads if h not in facts]
+            body = []
+            body_weights = []
+            for j, l in enumerate(literals):
+                value = known(l)
+                if value is None:
+                    body.append(l)
+                    if kind == 5: body_weights.append(weights[j])
+                elif kind == 5:
+                    if value: bound -= weights[j]
+                elif not value:
+                    heads = []  # the body is false
+                    break
+            if kind == 5 and bound > sum(body_weights):
+                heads = []
+            if not heads:
+                remove_rule(i)
+                stats['satisfied'] += 1
+                continue
+            if kind == 5 and bound <= 0:
+                kind, body = 1, []
+            if kind == 1 and heads[0] != 1 and not body:
+                facts.add(heads[0])
+                changed.add(heads[0])
+                remove_rule(i)
+            elif kind == 1 and heads[0] == 1 and len(body) == 1:
+                if body[0] > 0: required_false.add(body[0])
+                else: required_true.add(-body[0])
+                changed.add(abs(body[0]))
+                remove_rule(i)
+            else:
+                rules[i][:] = [kind, heads, body, bound, body_weights]
+                if kind == 3 and not body:
+                    free.update(heads)
+        # A chosen atom which is required is the same as a fact.
+        for a in (required_true & free) - facts:
+            facts.add(a)
+            changed.add(a)
+        pending = sorted(set([i for a in changed for i in occurs.get(a, [])]))
+        changed.clear()
+    # The single literal constraints are added back.
+    rules = [rule for rule in rules if rule is not None]
+    rules += [[1, [1], [a], None, None] for a in required_false - undefined]
+    rules += [[1, [1], [-a], None, None] for a in required_true - facts]
+    # Keep the rules defining atoms reachable from the constraints and
+    # named literals.
+    defining = {}
+    for rule in rules:
+        for h in rule[1]:
+            defining.setdefault(h, []).append(rule)
+    kept = [rule for rule in rules if rule[1] == [1]]
+    kept_ids = set()
+    stack = list(show) + [abs(l) for rule in kept for l in rule[2]]
+    reached = set(stack)
+    while stack:
+        a = stack.pop()
+        for rule in defining.get(a, []):
+            if id(rule) not in kept_ids:
+                kept_ids.add(id(rule))
+                kept.append(rule)
+                atoms = set([abs(l) for l in rule[2]]) - reached
+                stack.extend(atoms)
+                reached.update(atoms)
+    stats['unreachable'] = len(rules) - len(kept)
+    kept += [[1, [a], [], None, None] for a in sorted(facts) if a in reached]
+    # Write identical rules once, renumbering the atoms.
+    atoms = set([abs(l) for rule in kept for l in rule[1] + rule[2]])
+    atoms.discard(1)
+    numbers = [0] * (last_bool + 1)  # the new number of each atom
+    numbers[1] = 1
+    names = {}
+    for i, a in enumerate(sorted(atoms)):
+        numbers[a] = i + 2
+        names[i + 2] = a
+    new_rules = array('i')
+    new_starts = array('l')
+    seen = set()
+    for rule in kept:
+        kind, heads, literals, bound, weights = rule
+        heads = [numbers[h] for h in heads]
+        literals = [numbers[l] if l > 0 else -numbers[-l] for l in literals]
+        if kind == 5:
+            pairs = sorted(zip(literals, weights))
+            literals, weights = [l for l, w in pairs], [w for l, w in pairs]
+        else:
+            heads, literals = sorted(heads), sorted(set(literals))
+        vals = tuple(rule_vals([kind, heads, literals, bound, weights]))
+        if vals in seen:
+            stats['duplicate'] += 1
+            continue
+        seen.add(vals)
+        new_starts.append(len(new_rules))
+        new_rules.extend(vals)
+    stats['rules'] = len(rule_starts) - len(new_starts)
+    stats['atoms'] = last_bool - len(atoms) - 1
+    simplify_stats = stats
+    print ('Simplified to %d variables, %d rules, removing %d satisfied, '
+           '%d unreachable and %d duplicate rules' %
+           (len(atoms) + 1, len(new_starts), stats['satisfied'],
+            stats['unreachable'], stats['duplicate']))
+    show = sorted([numbers[a] for a in show if numbers[a]])
+    return new_rules, new_starts, show, names
+
+
+################################################################################
+##################################  Streaming  #################################
+################################################################################
+
+# In streaming mode, clasp is started right away, and rules are written
+# to it by a background thread in chunks of ENCODE_CHUNK rules as the
+# model is built, so that clasp parses the program while python is
+# still constructing it.  Only the rules of the current chunk are kept
+# in clasp_rules, so every literal is named in the solution, and the
+# program can only be solved once.  Since clasp's options are fixed
+# when it starts, it enumerates all solutions, projected onto the named
+# literals, and solve() stops it after the first one.
 
-    print 'Solving', last_bool, 'variables,', len(clasp_rules), 'rules'
+STREAM_CHUNKS = 16  # number of encoded chunks waiting to be written
 
-    clasp_process = subprocess.Popen(CLASP_COMMAND.split(),
+streaming = False
+def set_streaming(b=True):
+    """Set streaming mode, which writes rules to clasp as they are
+    created.  This resets the system."""
+    global streaming
+    streaming = b
+    reset()
+
+stream = None  # (clasp process, queue of chunks, writer thread)
+num_streamed = 0  # number of rules written to the stream
+
+def stop_stream():
+    """Stops clasp and the writer thread of the stream, if any."""
+    global stream
+    if stream is not None:
+        clasp_process, chunks, writer = stream
+        clasp_process.kill()
+        chunks.put(None)
+        writer.join()
+        clasp_process.wait()
+        stream = None
+atexit.register(stop_stream)
+
+def reset_stream():
+    """Stops the stream, and starts a new one in streaming mode."""
+    global stream, num_streamed
+    stop_stream()
+    num_streamed = 0
+    if not streaming:
+        return
+    clasp_process = subprocess.Popen(CLASP_COMMAND.split() + ['--models=0', '--project', '--stats'],
                                      stdin=subprocess.PIPE,
                                      stdout=subprocess.PIPE)
+    chunks = Queue.Queue(STREAM_CHUNKS)
+    writer = threading.Thread(target=write_chunks, args=(clasp_process.stdin, chunks))
+    writer.daemon = True
+    writer.start()
+    stream = (clasp_process, chunks, writer)
+
+def write_chunks(f, chunks):
+    """Writes each chunk of text from the queue to f, until None.
+    Runs in the writer thread."""
     try:
-        for rule in clasp_rules:
-            clasp_process.stdin.write(' '.join(map(str, rule)) + '\n')
+        for chunk in iter(chunks.get, None):
+            f.write(chunk)
+        f.close()
     except IOError:
         # The stream may be closed early if there is obviously no
         # solution.
         print 'Stream closed early!'
-        return False
+        while chunks.get() is not None:
+            pass
+
+def flush_stream():
+    """Writes the rules in clasp_rules to the stream, and clears them."""
+    global num_streamed
+    for chunk in encode_rules():
+        stream[1].put(chunk)
+    num_streamed += len(rule_starts)
+    del clasp_rules[:]
+    del rule_starts[:]
+
+def finish_stream(show=None, assume=()):
+    """Writes the rest of the program to the stream, naming the literals
+    in show, which are all literals by default, and assuming the
+    literals in assume.  Returns the clasp process."""
+    global stream, run_named
+    if stream is None:
+        raise RuntimeError('The streamed program was already solved.  ' +
+                           'Call reset() to build a new one.')
+    clasp_process, chunks, writer = stream
+    flush_stream()
+    if show is None:
+        show = range(2, last_bool + 1)
+    run_named = bytearray(last_bool + 1)
+    for i in show:
+        run_named[i] = 1
+    chunks.put(minimize_statements())
+    chunks.put('0\n')  # end of rules
+    for chunk in encode_symbols(show):
+        chunks.put(chunk)
+    chunks.put(compute_statement(assume))
+    chunks.put(None)
+    writer.join()
+    stream = None
+    return clasp_process
+
+
+################################################################################
+#############################  Incremental solving  ############################
+################################################################################
+
+# clasp only starts solving once its input is closed, so it can't be
+# kept running between calls to solve().  Instead, incremental mode
+# keeps the text of rules that were already encoded, and the lemmas
+# clasp learned in the last solve, which are read back in with
+# --lemma-in.  Lemmas over the old atoms stay valid as long as new
+# rules only add constraints or define new atoms.
+
+incremental = False
+def set_incremental(b=True):
+    """Set incremental mode, which keeps the encoded program and
+    learned lemmas between calls to solve()."""
+    global incremental
+    incremental = b
+    reset_session()
+
+encoded_rules = None  # text chunks of the first num_encoded rules
+num_encoded = 0
+session_dir = None  # temporary directory for lemma files
+session_lemmas = None  # lemmas learned so far, in aspif format
+lemma_bool = 0  # last_bool when the lemmas were learned
+
+def reset_session():
+    """Discard all state kept by incremental mode."""
+    global encoded_rules, num_encoded, session_dir
+    encoded_rules = []
+    num_encoded = 0
+    if session_dir is not None:
+        shutil.rmtree(session_dir, True)
+        session_dir = None
+    discard_lemmas()
+atexit.register(reset_session)
+
+def discard_lemmas():
+    global session_lemmas, lemma_bool
+    session_lemmas = []
+    lemma_bool = 0
+
+def rule_heads(vals):
+    """Returns the head atoms of a rule in SMODELS format."""
+    if vals[0] == 3:  # choice rule
+        return vals[2:2 + vals[1]]
+    return vals[1:2]
+
+def redefines_solved_atom(vals):
+    """Whether the rule adds a definition for an atom which existed
+    when the lemmas were learned, which could invalidate them."""
+    for head in rule_heads(vals):
+        if head != 1 and head <= lemma_bool:
+            return True
+    return False
 
-    print >>clasp_process.stdin, 0  # end of rules
-    # print the literal names
-    for i in range(2, last_bool+1):
-        print >>clasp_process.stdin, i, 'v' + str(i)
-    # print the compute statement
-    clasp_process.stdin.write('0\nB+\n0\nB-\n1\n0\n1\n')
-    if clasp_process.stdout is None:  # debug mode
+def program_rules():
+    """Returns the text chunks of all rules.  In incremental mode,
+    only rules added since the last call are encoded."""
+    global num_encoded
+    if not incremental:
+        return encode_rules()
+    encoded_rules.extend(encode_rules(num_encoded))
+    num_encoded = len(rule_starts)
+    return encoded_rules
+
+def lemma_options(log_lemmas=True):
+    """Returns the clasp options to read and log lemmas, writing the
+    lemmas learned so far to a file.  Lemmas should only be logged
+    when solving the plain program, without enumeration or other
+    constraints added by clasp."""
+    global session_dir
+    if not incremental:
+        return []
+    if session_dir is None:
+        session_dir = tempfile.mkdtemp(prefix='claspy')
+    options = []
+    if log_lemmas:
+        options += LEMMA_OPTIONS.split()
+        options.append('--lemma-out=' + os.path.join(session_dir, 'lemmas_out'))
+    if session_lemmas:
+        lemma_in = os.path.join(session_dir, 'lemmas_in')
+        f = open(lemma_in, 'w')
+        f.write('asp 1 0 0\n')
+        f.writelines(session_lemmas)
+        f.write('0\n')
+        f.close()
+        options.append('--lemma-in=' + lemma_in)
+    return options
+
+def collect_lemmas():
+    """Reads the lemmas logged by clasp in the last solve."""
+    global session_lemmas, lemma_bool
+    if not incremental:
         return
-    clasp_process.stdin.close()
-    found_solution = False
-    clasp_output = []
-    for line in clasp_process.stdout:
-        if line.startswith('c Answer:'):
-            solution = set()
-        if line[0] == 'v':  # this is a solution line
-            assert not found_solution
-            solution = set(map(lambda s: int(s[1:]), line.rstrip().split(' ')))
-            found_solution = True
+    try:
+        f = open(os.path.join(session_dir, 'lemmas_out'))
+    except IOError:
+        return
+    lines = f.readlines()[1:]  # skip the aspif header
+    f.close()
+    session_lemmas += [l for l in lines if l.startswith('1 ')]
+    del session_lemmas[:-MAX_LEMMAS]
+    lemma_bool = last_bool
+
+
+start_time = time()  # time when the library is loaded
+# The solution is a bitmap with one byte per literal.  Literals which
+# weren't named have a value of 0 until it is derived from the rules.
+solution = None  # solution[i] is 1 if literal i is true
+solution_known = None  # solution_known[i] is 1 if literal i's value is known
+solution_count = 0  # incremented for each solution, to invalidate cached values
+run_named = None  # the named literals in the current run of clasp
+
+def set_solution(answer, named):
+    """Stores an answer from clasp as the current solution, given the
+    literals which were named."""
+    global solution, solution_known, solution_count
+    solution = answer
+    solution_known = bytearray(named)
+    solution_count += 1
+
+def name_literals(show):
+    """Sets run_named to the literals in show, which are the visible
+    literals by default."""
+    global run_named
+    if show is None:
+        run_named = bytearray(visible)
+    else:
+        run_named = bytearray(max([last_bool] + list(show)) + 1)
+        for i in show:
+            run_named[i] = 1
+
+def start_clasp(options=[], show=None, assume=(), extra=''):
+    """Starts clasp with the given extra options and writes the
+    program to it, assuming the literals in assume, with the text of
+    extra rules.  Only the literals in show are named, which are the
+    visible literals by default.  Returns the clasp process, or None
+    if clasp closed the stream early."""
+    name_literals(show)
+    clasp_process = subprocess.Popen(CLASP_COMMAND.split() + options,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+    try:
+        write_program(clasp_process.stdin, show, assume, extra)
+        clasp_process.stdin.close()
+    except IOError:
+        # The stream may be closed early if there is obviously no
+        # solution.
+        print 'Stream closed early!'
+        return None
+    return clasp_process
+
+def start_portfolio(options, configs, assume=()):
+    """Starts clasp once for each string of options in configs, with
+    the given extra options, and writes the program, which is encoded
+    only once, to each.  A process that closes the stream early, for
+    example on a bad option, is left out of the race.  Returns the
+    clasp processes, or None if all of them closed the stream early."""
+    name_literals(None)
+    program = StringIO()
+    write_program(program, None, assume)
+    program = program.getvalue()
+    clasp_processes = []
+    for config in configs:
+        clasp_process = subprocess.Popen(CLASP_COMMAND.split() + options + config.split(),
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        try:
+            clasp_process.stdin.write(program)
+            clasp_process.stdin.close()
+            clasp_processes.append(clasp_process)
+        except IOError:
+            print 'Stream closed early for', repr(config) + '!'
+            stop_clasp(clasp_process)
+    return clasp_processes or None
+
+def thread_options(threads, mode):
+    """Returns the clasp options to solve with threads in the given
+    mode, 'compete' or 'split'."""
+    if mode not in ('compete', 'split'):
+        raise ValueError("mode must be 'compete' or 'split', not %r" % mode)
+    if not threads or threads == 1:
+        return []
+    return ['--parallel-mode=%d,%s' % (threads, mode)]
+
+def stop_clasp(clasp_process):
+    """Kills clasp if it is still running."""
+    if clasp_process.poll() is None:  # stopped early
+        clasp_process.kill()
+        clasp_process.wait()
+
+def read_answers(clasp_process, clasp_output, lines=None):
+    """Generates each answer set as clasp prints it, as a bytearray
+    with a 1 for each true literal.  All other lines of output are
+    appended to clasp_output.  If the lines of output are read
+    elsewhere, they are given in lines, and clasp_process may be None."""
+    answer_line = False
+    # readline, unlike iterating over the file, doesn't wait to fill
+    # a buffer, so answers are returned as soon as they are found.
+    if lines is None:
+        lines = iter(clasp_process.stdout.readline, '')
+    for line in lines:
+        if answer_line:  # the line after 'Answer:' lists the true literals
+            answer_line = False
             if verbose: print line.rstrip()
+            answer = bytearray(len(run_named))
+            for s in line.split():
+                answer[int(s[1:])] = 1
+            answer[TRUE_BOOL.index] = 1
+            yield answer
+        elif line.startswith('Answer:') or line.startswith('c Answer:'):
+            answer_line = True
         else:
             clasp_output.append(line.rstrip())
-    if 'SATISFIABLE' in clasp_output: print 'SATISFIABLE'
-    elif 'UNSATISFIABLE' in clasp_output: print 'UNSATISFIABLE'
+    if clasp_process is not None:
+        clasp_process.wait()
+
+RESULTS = ['CANCELLED', 'TIMEOUT', 'OPTIMUM FOUND', 'SATISFIABLE', 'UNSATISFIABLE']
+
+def result_name(clasp_output):
+    """Returns the outcome of running clasp, one of RESULTS, or
+    'ERROR'."""
+    for result in RESULTS:
+        if result in clasp_output:
+            return result
+    return 'ERROR'
+
+def print_result(clasp_output):
+    """Prints the outcome of running clasp."""
+    result = result_name(clasp_output)
+    if result != 'ERROR': print result
     else: print '\n'.join(clasp_output)  # show info if there was an error
     print
     print 'Total time: %.2fs' % (time() - start_time)
     print
+
+def check_debug_constraints():
+    """Prints any 'required' constraints which failed."""
     if solution and debug_constraints:
         for x, s in debug_constraints:
             if not x.value():
                 print "Failed constraint:", s
         print
-    last_update = time()  # reset for future searches
-    return found_solution
+
+class Timeout(object):
+    """The result of a solve which ran out of time.  It is false, like
+    the result of an unsatisfiable solve."""
+    def __nonzero__(self):
+        return False
+    def __repr__(self):
+        return 'TIMEOUT'
+TIMEOUT = Timeout()
+
+# After each solve, solve_stats has the time in seconds spent in each
+# of the SOLVE_PHASES: building the model since the last solve or
+# reset, writing the program to clasp, running clasp, and storing the
+# solution.  It also has the outcome, the size of the program, the
+# peak memory in KB of python and of clasp (the largest of all clasp
+# runs so far), and clasp's statistics, such as 'conflicts',
+# 'choices', 'restarts' and 'time_solving'.
+
+SOLVE_PHASES = ['build', 'serialize', 'clasp', 'parse']
+solve_stats = None  # statistics of the last solve
+build_start = None  # time when the model started to be built
+
+def parse_stat(s):
+    """Returns a statistic as a number, if it is one."""
+    number = s.rstrip('s%+')
+    for kind in (int, float):
+        try:
+            return kind(number)
+        except ValueError:
+            pass
+    return s
+
+def parse_clasp_stats(clasp_output):
+    """Returns a dictionary of the statistics clasp printed.  A line
+    'Conflicts : 12 (Analyzed: 10)' gives 'conflicts' and
+    'conflicts_analyzed', and indented lines are named after the line
+    above them, e.g. 'lemmas_binary'."""
+    stats = {}
+    parent = ''
+    for line in clasp_output:
+        match = re.match(r'(\s*)([A-Za-z][\w -]*?)\s*: (.*)$', line)
+        if not match:
+            continue
+        indent, key, rest = match.groups()
+        key = re.sub('[ -]', '_', key.lower())
+        if indent:
+            key = parent + '_' + key
+        else:
+            parent = key
+        main, _, details = rest.partition('(')
+        values = map(parse_stat, main.split())
+        if values:
+            stats[key] = values[0] if len(values) == 1 else values
+        for name, value in re.findall(r'([A-Za-z0-9][\w -]*?):\s*([-\d.]+)[s%]?', details):
+            stats[key + '_' + re.sub('[ -]', '_', name.strip().lower())] = parse_stat(value)
+    return stats
+
+def solve(threads=None, mode='compete', configs=None, assume=(), callback=None,
+          timeout=None):
+    """Solves for all defined variables.  If satisfiable, returns True
+    and stores the solution so that variables can print out their
+    values.  clasp uses the given number of threads, which either
+    compete to solve the whole problem or split the search space
+    between them, depending on mode.  If a list of clasp options is
+    given in configs, a separate clasp is run with each, and the first
+    to finish wins.  The boolean expressions in assume are required
+    for this solve only.  If there are objectives, clasp finds an
+    optimal solution, and callback is called with objective_values()
+    for each better solution as it is found.  If clasp takes more than
+    timeout seconds, it is stopped, and TIMEOUT is returned, unless a
+    solution to the objectives was already found."""
+    return solve_async(threads, mode, configs, assume, timeout).result(callback)
+
+def solve_async(threads=None, mode='compete', configs=None, assume=(), timeout=None):
+    """Starts clasp like solve(), and returns a SolveRun without waiting
+    for it to finish."""
+    start = time()
+    assume = [BoolVar(x).index for x in assume]
+    print 'Solving', last_bool, 'variables,', num_rules(), 'rules'
+
+    options = thread_options(threads, mode)
+    # Lemmas can't be logged by several clasps at once, and lemmas
+    # learned under assumptions or bounds on objectives may not hold
+    # without them.
+    log_lemmas = not streaming and not configs and not assume and not objectives
+    if streaming:
+        if options or configs:
+            raise ValueError('Streaming mode starts clasp with fixed options.')
+        clasp_processes = finish_stream(None, assume)
+    elif configs:
+        clasp_processes = start_portfolio(['--stats'] + options + lemma_options(False),
+                                          configs, assume)
+    else:
+        clasp_processes = start_clasp(['--stats'] + options + lemma_options(log_lemmas),
+                                      None, assume)
+    if clasp_processes is not None and type(clasp_processes) is not list:
+        clasp_processes = [clasp_processes]
+    run = SolveRun(clasp_processes, log_lemmas, timeout)
+    run.stats.update({'variables': last_bool, 'rules': num_rules(),
+                      'build': start - build_start, 'serialize': time() - start})
+    return run
+
+def finished_runs(runs):
+    """Generates each of the SolveRuns as it finishes."""
+    runs = list(runs)
+    finished = Queue.Queue()
+    for run in runs:
+        run.notify(finished)
+    for _ in runs:
+        yield finished.get()
+
+class SolveRun(object):
+    """A run of clasp started by solve_async().  A background thread
+    reads clasp's output, so that many runs can go on at once.  The
+    solution is stored by result(), in the model the run was started
+    in."""
+    def __init__(self, clasp_processes, log_lemmas, timeout):
+        self.clasp_processes = clasp_processes or []
+        self.model = active_model
+        self.named = run_named
+        self.streaming = streaming
+        self.live = streaming or bool(objectives)  # results are read as clasp prints them
+        self.log_lemmas = log_lemmas
+        self.timed_out = False
+        self.cancelled = False
+        self.winner = None
+        self.lines = Queue.Queue()  # the winner's lines of output, then None
+        self.finished = threading.Event()
+        self.lock = threading.Lock()  # for listeners
+        self.listeners = []  # queues to put the run in when it finishes
+        self.stats = {}  # becomes solve_stats when the result is stored
+        self.started = time()
+        self.finish_time = None
+        self.stored = False  # whether result() has stored the solution
+        self.found = None  # what result() returned
+        self.timer = None
+        if timeout is not None:
+            self.timer = threading.Timer(timeout, self.stop, [True])
+            self.timer.daemon = True
+            self.timer.start()
+        self.reader = threading.Thread(target=self.read)
+        self.reader.daemon = True
+        self.reader.start()
+    def read(self):
+        """Reads the output of the run.  Runs in the reader thread."""
+        if len(self.clasp_processes) == 1:
+            self.winner = self.clasp_processes[0]
+            for line in iter(self.winner.stdout.readline, ''):
+                self.lines.put(line)
+            self.winner.wait()
+        elif self.clasp_processes:
+            self.winner, lines = race_clasp(self.clasp_processes)
+            for line in lines:
+                self.lines.put(line)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.finish_time = time()
+        self.lines.put(None)
+        with self.lock:
+            self.finished.set()
+            for listener in self.listeners:
+                listener.put(self)
+    def notify(self, listener):
+        """Puts the run in the listener queue once it finishes."""
+        with self.lock:
+            if self.finished.is_set():
+                listener.put(self)
+            else:
+                self.listeners.append(listener)
+    def stop(self, timed_out=False):
+        self.timed_out = self.timed_out or timed_out
+        for clasp_process in self.clasp_processes:
+            stop_clasp(clasp_process)
+    def cancel(self):
+        """Stops clasp.  result() will return False."""
+        self.cancelled = True
+        self.stop()
+    def done(self):
+        """Whether clasp has finished."""
+        return self.finished.is_set()
+    def wait(self, timeout=None):
+        """Waits up to timeout seconds for clasp to finish, and returns
+        whether it has."""
+        self.finished.wait(timeout)
+        return self.done()
+    def result(self, callback=None):
+        """Waits for clasp, stores the solution, and returns True if
+        there is one, False if not, or TIMEOUT.  If there are
+        objectives, callback is called with objective_values() for
+        each better solution, as they are read.  Later calls return
+        the same value without storing the solution again."""
+        global last_update, optimal, run_named, build_start, solve_stats
+        global solution, solution_known, solution_count
+        if self.stored:
+            return self.found
+        if self.model is not active_model:
+            if self.model is None:
+                raise RuntimeError('The run was started in the default model.')
+            with self.model:
+                return self.result(callback)
+        if not self.clasp_processes:  # the stream was closed early
+            return False
+        if not self.live:
+            outside_model(self.wait)
+        parse_start = time()
+        previous = (solution, solution_known)  # kept if the run fails
+        run_named = self.named
+        found_solution = False
+        clasp_output = []
+        lines = iter(lambda: outside_model(self.lines.get), None)
+        for answer in read_answers(None, clasp_output, lines):
+            assert self.live or not found_solution
+            set_solution(answer, run_named)
+            found_solution = True
+            if callback:
+                callback(objective_values())
+            if self.streaming and not objectives:
+                self.stop()  # clasp enumerates all solutions in streaming mode
+                clasp_output.append('SATISFIABLE')
+                break
+        outside_model(self.reader.join)
+        optimal = 'OPTIMUM FOUND' in clasp_output
+        # The timer may fire after clasp has finished.
+        finished = any(r in clasp_output for r in ('SATISFIABLE', 'UNSATISFIABLE', 'OPTIMUM FOUND'))
+        if self.cancelled:
+            clasp_output.append('CANCELLED')
+            found_solution = False
+        elif self.timed_out and not finished and not (found_solution and objectives):
+            clasp_output.append('TIMEOUT')
+            found_solution = TIMEOUT
+        elif self.log_lemmas:
+            collect_lemmas()
+        if self.cancelled or found_solution is TIMEOUT:  # answers read so far don't count
+            solution, solution_known = previous
+            solution_count += 1
+        finish_time = self.finish_time or time()  # None if clasp was stopped early
+        self.stats.update({'result': result_name(clasp_output),
+                           'clasp': finish_time - self.started,
+                           'parse': time() - max(parse_start, finish_time),
+                           'python_max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                           'clasp_max_rss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                           'clasp_stats': parse_clasp_stats(clasp_output)})
+        self.stats['total'] = sum([self.stats[phase] for phase in SOLVE_PHASES])
+        solve_stats = self.stats
+        print_result(clasp_output)
+        check_debug_constraints()
+        last_update = time()  # reset for future searches
+        build_start = time()
+        self.stored = True
+        self.found = found_solution
+        return found_solution
+
+def var_literals(x):
+    """Returns the indices of the positive literals used by a
+    variable, or by a list of variables."""
+    if isinstance(x, BoolVar):
+        return [abs(x.index)]
+    elif type(x) is IntVar:
+        return [abs(b.index) for b in x.bits]
+    elif isinstance(x, DomainIntVar):
+        return [abs(b.index) for b in x.bools]
+    elif type(x) is LinearSum:
+        return var_literals([v for c, v in x.terms])
+    elif type(x) is MultiVar:
+        return [abs(b.index) for b in x.vals.values()]
+    elif type(x) in (list, tuple):
+        return sum(map(var_literals, x), [])
+    return []  # constants have no literals
+
+def iter_solutions(limit=None, project=None):
+    """Generates up to limit solutions (all by default) from a single
+    run of clasp.  Variables take on the values of each solution in
+    turn.  If a list of variables is given to project, solutions are
+    only distinguished by the values of those variables, and other
+    variables should not be used."""
+    global last_update
+
+    print 'Enumerating', last_bool, 'variables,', num_rules(), 'rules'
+
+    options = ['--models=' + str(limit or 0)] + lemma_options(False)
+    show = None
+    if project is not None:
+        options.append('--project')
+        show = sorted(set([TRUE_BOOL.index] + var_literals(project)))
+    if streaming:
+        clasp_process = finish_stream(show)
+    else:
+        clasp_process = start_clasp(options, show)
+    if clasp_process is None:
+        return
+    clasp_output = []
+    count = 0
+    lines = iter(lambda: outside_model(clasp_process.stdout.readline), '')
+    try:
+        for answer in read_answers(clasp_process, clasp_output, lines):
+            set_solution(answer, run_named)
+            yield solution
+            count += 1
+            if streaming and count == limit:
+                break
+    finally:
+        stop_clasp(clasp_process)
+        last_update = time()  # reset for future searches
+    print_result(clasp_output)
+    check_debug_constraints()
+
+def count_solutions(limit=2, project=None, assume=()):
+    """Returns the number of solutions, counting up to limit (all if
+    None), without decoding them.  If a list of variables is given to
+    project, solutions are only distinguished by the values of those
+    variables.  The boolean expressions in assume are required for
+    this count only."""
+    assume = [BoolVar(x).index for x in assume]
+    print 'Counting', last_bool, 'variables,', num_rules(), 'rules'
+
+    # Models aren't printed, and objectives are ignored.
+    options = ['--models=' + str(limit or 0), '--quiet=2', '--opt-mode=ignore']
+    options += lemma_options(False)
+    show = None  # the visible literals, which simplification must keep
+    if project is not None:
+        options.append('--project')
+        show = sorted(set([TRUE_BOOL.index] + var_literals(project)))
+    if streaming:
+        clasp_process = finish_stream(show, assume)
+    else:
+        clasp_process = start_clasp(options, show, assume)
+    if clasp_process is None:
+        return 0
+    clasp_output = []
+    count = 0
+    for answer in read_answers(clasp_process, clasp_output):
+        count += 1  # only in streaming mode, which prints the models
+        if count == limit:
+            break
+    stop_clasp(clasp_process)
+    for line in clasp_output:
+        if line.startswith('Models'):  # e.g. 'Models       : 2+'
+            count = int(line.split(':')[1].strip().rstrip('+'))
+    print 'Found', count, 'solutions'
+    return count
+
+# forced_values() and possible_values() use clasp's cautious and brave
+# reasoning, which find the atoms that are true in all solutions, or in
+# some solution, in a single run.  Each value of a variable gets an
+# atom which is true when the variable has that value, so that the
+# consequences can be mapped back to values.  These atoms are numbered
+# after last_bool, and their rules are only written to that run of
+# clasp, so the query leaves the model unchanged.  A binary IntVar's
+# forced value is read from an atom for each value of each bit.
+
+QUERY_VALUES = 4096  # most values possible_values() tries for a binary IntVar
+
+def value_bodies(x, mode):
+    """Returns a list of (key, body) pairs for the variable x, where the
+    body is a list of literals which are true when x matches the key,
+    and a function which returns the set of values of x given the set
+    of keys that are consequences."""
+    if isinstance(x, BoolVar):
+        return [(False, [-x.index]), (True, [x.index])], set
+    elif type(x) is OrderIntVar:
+        return [(v, [x.bound(k).index, -x.bound(k + 1).index])
+                for k, v in enumerate(x.domain)], set
+    elif isinstance(x, DomainIntVar):
+        return [(v, [b.index]) for v, b in zip(x.domain, x.bools)], set
+    elif type(x) is IntVar and mode == 'cautious':
+        def decode(keys):
+            if len(keys) < len(x.bits):  # some bit isn't forced
+                return set()
+            return set([sum([bit << i for i, bit in keys])])
+        return [((i, bit), [b.index if bit else -b.index])
+                for i, b in enumerate(x.bits) for bit in (0, 1)], decode
+    elif type(x) is IntVar:
+        if x.max_val - x.min_val >= QUERY_VALUES:
+            raise ValueError('Too many values to check: IntVar(%d,%d).  '
+                             'Use iter_solutions(project=[x]) instead.'
+                             % (x.min_val, x.max_val))
+        return [(v, [b.index if v >> i & 1 else -b.index for i, b in enumerate(x.bits)])
+                for v in xrange(x.min_val, x.max_val + 1)], set
+    elif type(x) is MultiVar:
+        return [(v, [b.index]) for v, b in x.vals.iteritems()], set
+    raise TypeError("Can't find the values of: " + str(x))
+
+def consequences(x, mode, assume):
+    """Runs clasp in the given enum mode, 'cautious' or 'brave', and
+    returns the set of possible values of each variable in x, as a
+    nested list like x, or None if there is no solution."""
+    if streaming:
+        raise ValueError('Streaming mode starts clasp with fixed options.')
+    leaves = []
+    rules, starts = array('i'), array('i')
+    def flatten(y):
+        if type(y) in (list, tuple):
+            for z in y:
+                flatten(z)
+        else:
+            pairs, decode = value_bodies(y, mode)
+            atoms = []
+            for key, body in pairs:
+                atom = last_bool + len(starts) + 1
+                starts.append(len(rules))
+                rules.extend(basic_rule_vals(atom, body))
+                atoms.append((key, atom))
+            leaves.append((atoms, decode))
+    flatten(x)
+    assume = [BoolVar(a).index for a in assume]
+    print 'Finding', mode, 'consequences of', last_bool, 'variables,', num_rules(), 'rules'
+
+    # Only the final consequences are printed, over all solutions.
+    options = ['--enum-mode=' + mode, '--models=0', '--quiet=1', '--opt-mode=ignore']
+    show = [TRUE_BOOL.index] + range(last_bool + 1, last_bool + len(starts) + 1)
+    clasp_process = start_clasp(options + lemma_options(False), show, assume,
+                                ''.join(encode_rules(0, rules, starts)))
+    if clasp_process is None:
+        return None
+    clasp_output = []
+    answer = None
+    for answer in read_answers(clasp_process, clasp_output):
+        pass
+    print_result(clasp_output)
+    if answer is None:
+        return None
+    leaf_values = iter([decode(set([key for key, a in atoms if answer[a]]))
+                        for atoms, decode in leaves])
+    def unflatten(y):
+        if type(y) in (list, tuple):
+            return [unflatten(z) for z in y]
+        return leaf_values.next()
+    return unflatten(x)
+
+def forced_values(x, assume=()):
+    """Returns the value of a variable, or a nested list of variables,
+    which it has in every solution, or None where it isn't forced.
+    Returns None if there is no solution."""
+    result = consequences(x, 'cautious', assume)
+    if result is None:
+        return None
+    def forced(y):
+        if type(y) is list:
+            return [forced(z) for z in y]
+        return list(y)[0] if len(y) == 1 else None
+    return forced(result)
+
+def possible_values(x, assume=()):
+    """Returns the set of values which a variable, or a nested list of
+    variables, has in some solution.  Returns None if there is no
+    solution."""
+    return consequences(x, 'brave', assume)
+
+rule_index = None  # dictionary from head literal to its rule numbers
+num_indexed = 0  # number of rules in rule_index
+def index_rules():
+    """Adds all new rules to rule_index."""
+    global num_indexed
+    for i in xrange(num_indexed, len(rule_starts)):
+        start = rule_starts[i]
+        if clasp_rules[start] in (1, 2, 5):  # rules with a single head
+            rule_index.setdefault(clasp_rules[start+1], []).append(i)
+    num_indexed = len(rule_starts)
+
+def rule_body(i):
+    """Returns the body literals of rule number i, with the bound and
+    weights for weight rules."""
+    rule = get_rule(i)
+    if rule[0] == 1:  # 1 head #literals #negative [negative] [positive]
+        n, neg = rule[2], rule[3]
+        return [-x for x in rule[4:4+neg]] + list(rule[4+neg:4+n]), n, None
+    elif rule[0] == 2:  # 2 head #literals #negative bound [negative] [positive]
+        n, neg = rule[2], rule[3]
+        literals = [-x for x in rule[5:5+neg]] + list(rule[5+neg:5+n])
+        return list(set(literals)), rule[4], None
+    else:  # 5 head bound #literals #negative [negative] [positive] [weights]
+        n, neg = rule[3], rule[4]
+        literals = [-x for x in rule[5:5+neg]] + list(rule[5+neg:5+n])
+        return literals, rule[2], list(rule[5+n:5+2*n])
+
+def literal_value(i):
+    """Returns the value of the positive literal i in the solution."""
+    if active_model is not None: check_thread()
+    if i >= len(solution):  # created after solving
+        return False
+    if not solution_known[i]:
+        derive_value(i)
+    return solution[i] == 1
+
+def literal_values(literals):
+    """Returns the values of a list of literals, positive or negative,
+    as a list of 0s and 1s."""
+    if active_model is not None: check_thread()
+    n = len(solution)
+    for l in literals:
+        if abs(l) < n and not solution_known[abs(l)]:
+            derive_value(abs(l))
+    return [(solution[l] if l < n else 0) if l > 0 else
+            (1 - solution[-l] if -l < n else 1) for l in literals]
+
+def literal_values_array(literals):
+    """Returns the values of a list of literals as a NumPy array."""
+    if active_model is not None: check_thread()
+    literals = numpy.array(literals, dtype=numpy.int64)
+    indices = numpy.abs(literals)
+    n = len(solution)
+    new = indices >= n  # created after solving, so false
+    indices[new] = 0
+    known = numpy.frombuffer(bytes(solution_known), dtype=numpy.uint8)
+    for i in numpy.unique(indices[known[indices] == 0]):
+        if i > 1:
+            derive_value(int(i))
+    values = numpy.frombuffer(bytes(solution), dtype=numpy.uint8)[indices]
+    values[new] = 0
+    return values.astype(numpy.int64) ^ (literals < 0)
+
+def derive_value(x):
+    """Computes the value of a literal which wasn't named, from the
+    rules which define it.  Such literals are gates defined in terms of
+    older literals, so the rules can be evaluated from the bottom up."""
+    def known(i):
+        return i >= len(solution) or solution_known[i]
+    def get(l):
+        # An unknown value is 0, which only happens in a cycle.
+        value = solution[abs(l)] if abs(l) < len(solution) else 0
+        return value if l > 0 else 1 - value
+    index_rules()
+    stack = [x]
+    on_stack = set(stack)
+    while stack:
+        i = stack[-1]
+        bodies = [rule_body(r) for r in rule_index.get(i, [])]
+        unknown = set([abs(l) for body in bodies for l in body[0]
+                       if not known(abs(l)) and abs(l) not in on_stack])
+        if unknown:
+            stack.extend(unknown)
+            on_stack.update(unknown)
+            continue
+        stack.pop()
+        on_stack.discard(i)
+        value = False
+        for literals, bound, weights in bodies:
+            values = map(get, literals)
+            if weights is None:
+                value = sum(values) >= bound
+            else:
+                value = sum([w for v, w in zip(values, weights) if v]) >= bound
+            if value:
+                break
+        solution[i] = value
+        solution_known[i] = 1
+
+def values(x, as_array=False):
+    """Returns the values of a variable or a nested list of variables,
+    decoding all of their literals in one pass.  If as_array is True,
+    returns a NumPy array."""
+    leaves = []
+    def flatten(y):
+        if type(y) in (list, tuple):
+            for z in y:
+                flatten(z)
+        else:
+            leaves.append(y)
+    flatten(x)
+    # Look up every bit of every BoolVar and IntVar together.
+    literals = []
+    for v in leaves:
+        if isinstance(v, BoolVar):
+            literals.append(v.index)
+        elif type(v) is IntVar:
+            literals.extend([b.index for b in v.bits])
+    ints = [v for v in leaves if type(v) is IntVar]
+    widths = set([len(v.bits) for v in ints])
+    if numpy is not None and len(widths) == 1 and len(ints) == len(leaves):
+        # Decode all IntVars at once with NumPy.
+        width = widths.pop()
+        weights = numpy.left_shift(1, numpy.arange(width, dtype=numpy.int64))
+        bits = literal_values_array(literals)
+        leaf_values = bits.reshape(-1, width).dot(weights).tolist()
+    else:
+        bits = literal_values(literals)
+        leaf_values = []
+        pos = 0
+        for v in leaves:
+            if isinstance(v, BoolVar):
+                leaf_values.append(bits[pos] == 1)
+                pos += 1
+            elif type(v) is IntVar:
+                leaf_values.append(sum([1 << i for i in range(len(v.bits))
+                                        if bits[pos + i]]))
+                pos += len(v.bits)
+            elif isinstance(v, IntVar) or type(v) is MultiVar:
+                leaf_values.append(v.value())
+            else:  # constants are their own values
+                leaf_values.append(v)
+    leaf_values = iter(leaf_values)
+    def unflatten(y):
+        if type(y) in (list, tuple):
+            return [unflatten(z) for z in y]
+        return leaf_values.next()
+    result = unflatten(x)
+    if as_array:
+        if numpy is None:
+            raise ImportError('values(as_array=True) requires NumPy')
+        return numpy.array(result)
+    return result
+
+
+################################################################################
+###################################  Models  ###################################
+################################################################################
+
+# The state of a model, its rules, variables and solution, is kept in
+# the module-level globals listed in MODEL_STATE, together with the
+# caches of memoized functions.  The globals belong to the active
+# model, which is the default model unless a Model is entered with
+# `with model:`.  Entering a model saves the state of the previous
+# one and loads the model's own, and leaving it swaps them back.
+#
+# Only one thread at a time can be inside `with model:`; other threads
+# wait to enter their own models.  While clasp runs, including while
+# solutions are read as clasp prints them, the model is left, so that
+# several threads can solve their models at once.  Variables of one
+# model must not be used in another.
+#
+# A thread can only be inside one Model at a time, since entering a
+# second would swap out the state of the first, for example from an
+# interleaved generator.  The default model takes no lock, so the
+# functions that read and write the state call check_thread(), which
+# raises instead of using a Model that another thread has entered.
+# Threads running at once should each use their own Model.
+
+MODEL_STATE = ['TRUE_BOOL', 'FALSE_BOOL', 'NUM_BITS', 'BITS', 'last_bool',
+               'visible', 'tight', 'debug_constraints', 'clasp_rules',
+               'rule_starts', 'single_vars', 'rule_index', 'num_indexed',
+               'gates', 'gate_inputs', 'saved_literals', 'saved_rules',
+               'solution', 'solution_known', 'run_named',
+               'simplify', 'simplify_stats', 'streaming', 'stream',
+               'num_streamed', 'incremental', 'encoded_rules', 'num_encoded',
+               'session_dir', 'session_lemmas', 'lemma_bool', 'objectives',
+               'optimal', 'build_start', 'solve_stats']
+
+model_lock = threading.RLock()  # held by the thread inside `with model:`
+active_model = None  # the entered Model, or None for the default model
+models = weakref.WeakSet()  # all Models, to clean them up at exit
+
+def save_state():
+    """Returns the state of the active model."""
+    g = globals()
+    return ([g[name] for name in MODEL_STATE],
+            [m.cache for m in memo_caches])
+
+def load_state(state):
+    """Makes the given state that of the active model."""
+    values, caches = state
+    globals().update(zip(MODEL_STATE, values))
+    for m, cache in zip(memo_caches, caches):
+        m.cache = cache
+
+def check_thread():
+    """Raises RuntimeError if another thread has entered the active
+    model, whose state this thread would otherwise use."""
+    if active_model is not None and active_model.thread is not threading.current_thread():
+        raise RuntimeError('Another thread is inside `with model:`.  '
+                           'Use a Model in each thread.')
+
+class Model(object):
+    """A model with its own variables, rules and solution, which is
+    used by all claspy functions inside `with model:`."""
+    def __init__(self):
+        global active_model
+        self.thread = threading.current_thread()
+        with model_lock:
+            outer = (active_model, save_state())
+            active_model = self  # so that other threads don't use the state
+            new_model()
+            self.state = save_state()
+            active_model = outer[0]
+            load_state(outer[1])
+        self.outer = None  # state of the default model when entered
+        models.add(self)
+    def __enter__(self):
+        global active_model
+        model_lock.acquire()
+        if active_model is not None:
+            model_lock.release()
+            raise RuntimeError('The thread is already inside `with model:`.')
+        self.thread = threading.current_thread()
+        self.outer = save_state()
+        load_state(self.state)
+        active_model = self
+        return self
+    def __exit__(self, *exc_info):
+        global active_model
+        self.state = save_state()
+        load_state(self.outer)
+        active_model = None
+        self.outer = None
+        model_lock.release()
+    def close(self):
+        """Stops the model's stream and removes its session files."""
+        with self:
+            stop_stream()
+            reset_session()
+
+def new_model():
+    """Replaces the active model with a new one with default settings,
+    leaving the stream and session of the old one alone."""
+    global incremental, streaming, simplify, session_dir, stream
+    incremental = streaming = simplify = False
+    session_dir = stream = None
+    reset()
+
+def close_models():
+    for model in list(models):
+        model.close()
+atexit.register(close_models)
+
+def outside_model(f, *args):
+    """Returns f(*args), which must not use claspy's state.  Inside
+    `with model:`, other threads can use their models meanwhile."""
+    model = active_model
+    if model is None:
+        return f(*args)
+    model.__exit__()
+    try:
+        return f(*args)
+    finally:
+        model.__enter__()
+
+def race_clasp(clasp_processes):
+    """Returns the first of the clasp processes to find a result, and
+    the lines it printed, and kills the others.  If none of them
+    finds a result, the last one to finish is returned."""
+    finished = Queue.Queue()
+    for clasp_process in clasp_processes:
+        reader = threading.Thread(target=lambda p: finished.put((p, p.stdout.readlines())),
+                                  args=(clasp_process,))
+        reader.daemon = True
+        reader.start()
+    for _ in clasp_processes:
+        winner, lines = finished.get()
+        if any(l.rstrip() in ('SATISFIABLE', 'UNSATISFIABLE', 'OPTIMUM FOUND')
+               for l in lines):
+            break
+    for clasp_process in clasp_processes:
+        if clasp_process is not winner:
+            stop_clasp(clasp_process)
+    return winner, lines
+
+
+################################################################################
+################################  Batch solving  ###############################
+################################################################################
+
+# solve_many() solves independent instances in worker processes.
+# Each worker starts from a new model, and runs builder(instance) for
+# each of its instances, which builds the model and returns the
+# variables to report.  The output of claspy in the workers is
+# captured, and only used to report errors.  Each worker has its own
+# pipe and is sent one instance at a time, so when a worker dies, its
+# pipe closes and the instance it had is known.  It is replaced by a
+# new worker.
+
+def worker_loop(conn):
+    """Solves the instances that solve_many() sends on conn, in a
+    worker process, and sends back their results."""
+    new_model()
+    while True:
+        try:
+            args = cPickle.loads(conn.recv_bytes())
+        except EOFError:  # solve_many() finished
+            return
+        result = solve_instance(args)
+        try:
+            conn.send(result)
+        except Exception, e:  # the values couldn't be pickled
+            conn.send(result[:1] + (None, result[2], '%s: %s' % (type(e).__name__, e)))
+
+def start_worker():
+    """Starts a worker process for solve_many(), and returns it with
+    the main process's end of its pipe."""
+    conn, worker_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=worker_loop, args=(worker_conn,))
+    process.daemon = True
+    process.start()
+    worker_conn.close()
+    return process, conn
+
+def solve_instance(args):
+    """Builds and solves one instance in a worker process.  Returns
+    (index, values, seconds, error)."""
+    index, builder, instance = args
+    start = time()
+    sys.stdout = output = StringIO()
+    try:
+        reset()
+        variables = builder(instance)
+        result = values(variables) if solve() else None
+        error = None
+        if ('SATISFIABLE' not in output.getvalue() and
+            'OPTIMUM FOUND' not in output.getvalue()):  # clasp failed
+            result, error = None, output.getvalue().strip()
+    except Exception, e:
+        result, error = None, '%s: %s' % (type(e).__name__, e)
+    finally:
+        sys.stdout = sys.__stdout__
+    return index, result, time() - start, error
+
+POLL_SECONDS = 0.05  # how often solve_many() checks for finished instances
+def solve_many(builder, instances, workers=None, max_pending=None):
+    """Solves each instance in worker processes, which are one per CPU
+    by default.  builder(instance) should build the model and return
+    the variables to report, and must be picklable, such as a
+    module-level function.  Generates (index, values, seconds, error)
+    for each instance in the order they finish, where values are the
+    values of the variables, or None if there is no solution or the
+    instance failed with the given error.  At most max_pending
+    instances, two per worker by default, are taken from instances
+    before their results are generated.  An instance whose worker
+    process dies, or which can't be sent to a worker, or whose values
+    can't be sent back, fails with an error."""
+    workers = workers or multiprocessing.cpu_count()
+    max_pending = max_pending or 2 * workers
+    tasks = enumerate(instances)
+    idle = [start_worker() for _ in range(min(workers, max_pending))]
+    busy = {}  # (index, start time) of the instance each busy worker has
+    try:
+        while True:
+            while idle:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                index, instance = task
+                try:
+                    data = cPickle.dumps((index, builder, instance), cPickle.HIGHEST_PROTOCOL)
+                except Exception, e:
+                    yield index, None, 0.0, '%s: %s' % (type(e).__name__, e)
+                    continue
+                worker = idle.pop()
+                busy[worker] = (index, time())
+                try:
+                    worker[1].send_bytes(data)
+                except IOError:  # the worker died while idle; it is caught below
+                    pass
+            if not busy:
+                return
+            for worker, (index, start) in busy.items():
+                process, conn = worker
+                result = None
+                if conn.poll():
+                    try:
+                        result = conn.recv()
+                    except (EOFError, IOError):  # the pipe closed when the worker died
+                        pass
+                elif process.is_alive():
+                    continue
+                del busy[worker]
+                if result is None:
+                    process.join()
+                    conn.close()
+                    worker = start_worker()
+                    result = index, None, time() - start, 'The worker process died.'
+                idle.append(worker)
+                yield result
+            sleep(POLL_SECONDS)
+    finally:
+        for process, conn in idle + busy.keys():
+            process.terminate()
+            process.join()
+            conn.close()
+
+
+################################################################################
+###############################  Program caching  ##############################
+################################################################################
+
+# save_program() writes the rules of the active model to a binary
+# file, along with the variables it was built for, so that
+# load_program() can restore them without building the model again.
+# The file has a header, the visible and tight flags of each literal,
+# the raw clasp_rules and rule_starts arrays, and a pickle of the
+# variables and the tables for sharing gates and single-literal rules.
+# It is memory-mapped when loaded, and the arrays are copied straight
+# from the mapping.  The pickle is still parsed into Python objects,
+# which takes time in proportion to the number of gates, and can run
+# code, so only files you trust should be loaded.  Memoized functions
+# start with empty caches, so new constraints on the loaded variables
+# may repeat some rules.
+#
+# cached_program() keeps its files in a directory that only the user
+# can read or write, since they are unpickled.
+
+PROGRAM_MAGIC = 'claspy program 2\n'
+PROGRAM_HEADER = struct.Struct('<7q')  # last_bool, NUM_BITS, itemsizes, lengths
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                         'claspy')
+
+def save_program(filename, variables=None):
+    """Saves the rules of the model, and the given variables, to a
+    file which load_program() can read."""
+    if streaming:
+        raise RuntimeError('The rules of a streamed program were already sent to clasp.')
+    tables = cPickle.dumps((variables, single_vars, gates, gate_inputs, debug_constraints,
+                            objectives), cPickle.HIGHEST_PROTOCOL)
+    temp_name = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(temp_name, 'wb')
+    f.write(PROGRAM_MAGIC)
+    f.write(PROGRAM_HEADER.pack(last_bool, NUM_BITS,
+                                clasp_rules.itemsize, rule_starts.itemsize,
+                                len(clasp_rules), len(rule_starts), len(tables)))
+    f.write(visible)
+    f.write(tight)
+    clasp_rules.tofile(f)
+    rule_starts.tofile(f)
+    f.write(tables)
+    f.close()
+    os.rename(temp_name, filename)  # atomic, for concurrent savers
+
+def load_program(filename):
+    """Resets the system, and loads the rules saved in the file by
+    save_program().  Returns the saved variables.  Raises ValueError
+    if the file isn't a complete program saved by this version.  The
+    variables and gate tables are unpickled, so the file must be
+    trusted."""
+    global last_bool, NUM_BITS, BITS, visible, tight, clasp_rules, rule_starts
+    global single_vars, gates, gate_inputs, debug_constraints, objectives
+    if streaming:
+        raise RuntimeError('A program cannot be loaded in streaming mode.')
+    f = open(filename, 'rb')
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    try:
+        pos = len(PROGRAM_MAGIC)
+        if data[:pos] != PROGRAM_MAGIC or len(data) < pos + PROGRAM_HEADER.size:
+            raise ValueError('%s is not a saved claspy program' % filename)
+        header = PROGRAM_HEADER.unpack_from(data, pos)
+        pos += PROGRAM_HEADER.size
+        (num_literals, num_bits, rules_size, starts_size,
+         num_vals, num_starts, tables_size) = header
+        if (rules_size, starts_size) != (array('i').itemsize, array('l').itemsize):
+            raise ValueError('%s was saved on an incompatible system' % filename)
+        if len(data) != (pos + 2 * (num_literals + 1) + num_vals * rules_size +
+                         num_starts * starts_size + tables_size):
+            raise ValueError('%s is truncated' % filename)
+        reset()
+        last_bool = num_literals
+        clasp_rules = array('i')
+        NUM_BITS = num_bits
+        BITS = range(NUM_BITS)
+        visible = bytearray(buffer(data, pos, last_bool + 1))
+        pos += last_bool + 1
+        tight = bytearray(buffer(data, pos, last_bool + 1))
+        pos += last_bool + 1
+        clasp_rules.fromstring(buffer(data, pos, num_vals * rules_size))
+        pos += num_vals * rules_size
+        rule_starts = array('l')
+        rule_starts.fromstring(buffer(data, pos, num_starts * starts_size))
+        pos += num_starts * starts_size
+        tables = cPickle.loads(data[pos:pos+tables_size])
+    finally:
+        data.close()
+    variables, single_vars, gates, gate_inputs, debug_constraints, objectives = tables
+    return variables
+
+def code_key(code):
+    """Returns the bytecode, names and constants of a code object, and
+    of the code nested in it, which change when a function is edited."""
+    return (code.co_code, code.co_names,
+            tuple([code_key(c) if type(c) is type(code) else c for c in code.co_consts]))
+
+def code_names(code):
+    """Returns the global and attribute names used by a code object,
+    and by the code nested in it."""
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if type(c) is type(code):
+            names |= code_names(c)
+    return names
+
+CONSTANT_TYPES = (int, long, float, complex, str, unicode, bool, type(None))
+def is_constant(x):
+    """Whether x is a constant, or a tuple of constants."""
+    return type(x) in CONSTANT_TYPES or (type(x) is tuple and all(map(is_constant, x)))
+
+def function_key(f, strict, seen=None):
+    """Returns a key for a function and what it depends on: its code,
+    default arguments and closure, and the constant globals and
+    functions of the same module that it uses, recursively.  Mutable
+    globals and other modules are left out.  Raises TypeError for a
+    closure value or default that can't be keyed if strict."""
+    seen = seen or set()
+    if f in seen:
+        return f.__name__
+    seen.add(f)
+    values = []
+    for x in list(f.__defaults__ or ()) + [c.cell_contents for c in f.__closure__ or ()]:
+        if type(x) is type(f):
+            values.append(function_key(x, strict, seen))
+        elif is_constant(x):
+            values.append(x)
+        elif strict:
+            raise TypeError('%s depends on %r.  Give cached_program() a key.'
+                            % (f.__name__, x))
+    used = []
+    for name in sorted(code_names(f.__code__)):
+        x = f.__globals__.get(name)
+        if type(x) is type(f) and x.__module__ == f.__module__:
+            used.append((name, function_key(x, strict, seen)))
+        elif name in f.__globals__ and is_constant(x):
+            used.append((name, x))
+    return code_key(f.__code__), tuple(values), tuple(used)
+
+def private_cache_dir():
+    """Creates CACHE_DIR if needed, and checks that only the user can
+    write to it."""
+    try:
+        os.makedirs(CACHE_DIR, 0700)
+    except OSError:  # it already exists
+        pass
+    info = os.lstat(CACHE_DIR)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+        info.st_mode & 0077):
+        raise RuntimeError('%s must be a directory that only you can use' % CACHE_DIR)
+
+def cached_program(builder, args=(), key=None):
+    """Resets the system, and returns builder(*args), which should
+    build the model and return its variables, the first time it is
+    called with a key.  Later calls with the same key load the saved
+    program from CACHE_DIR instead.  The key is builder's name and
+    args by default.  Editing builder, a function of its module that
+    it calls, or a constant it uses, or a new file format, changes the
+    key, and a file that can't be loaded is built again.  If builder
+    has a closure value that isn't a constant or a function, a key
+    must be given."""
+    strict = key is None
+    if key is None:
+        key = (builder.__module__, builder.__name__, args)
+    if type(builder) is type(cached_program):
+        key = (PROGRAM_MAGIC, function_key(builder, strict), key)
+    else:
+        key = (PROGRAM_MAGIC, key)
+    digest = hashlib.sha1(cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL)).hexdigest()
+    filename = os.path.join(CACHE_DIR, digest + '.claspy')
+    private_cache_dir()
+    if os.path.exists(filename):
+        try:
+            return load_program(filename)
+        except ValueError:  # from an old version, or cut short
+            pass
+    reset()
+    variables = builder(*args)
+    save_program(filename, variables)
+    return variables
 
 
 ################################################################################
 ##################################  Booleans  ##################################
 ################################################################################
 
+# Gates are hashed by their normalized inputs, so that equivalent
+# expressions share one literal.  Operands are sorted, and their
+# polarity normalized: a ^ b is a == ~b, and ~a == ~b is a == b.
+# Constants, repeated operands and operands of nested and/or gates
+# are folded, and and/or gates reuse the dual gate by De Morgan's laws.
+#
+# Answer sets only differ from classical logic in positive loops,
+# which can only pass through Atoms.  Folds that rely on the excluded
+# middle, such as a | ~a == True, are only made for tight literals,
+# which don't depend on any Atom.  De Morgan's laws always hold for
+# negative literals, since their values are only read from the answer.
+
+gates = None  # dictionary from (op, inputs) to the literal of the gate
+gate_inputs = None  # dictionary from the literal of an 'and' or 'or' gate to (op, inputs)
+tight = None  # tight[i] is 1 if literal i doesn't depend on an Atom
+saved_literals = 0  # number of literals saved by folding and sharing gates
+saved_rules = 0  # number of rules saved by folding and sharing gates
+
+def set_tight(head, literals):
+    """Marks the head of a new rule as tight if all of its literals are."""
+    tight[head] = all(tight[abs(l)] for l in literals)
+
+def is_tight(*literals):
+    return all(tight[abs(l)] for l in literals)
+
+def save(num_rules, num_literals=1):
+    """Records that a gate was folded or shared."""
+    global saved_literals, saved_rules
+    saved_literals += num_literals
+    saved_rules += num_rules
+
+def gate_view(x, op):
+    """Returns the inputs of literal x as an op gate, which is 'and' or
+    'or', with De Morgan's laws for inverted gates.  Returns an empty
+    tuple if x isn't such a gate."""
+    if x > 0:
+        op_x, inputs = gate_inputs.get(x, (None, ()))
+        return inputs if op_x == op else ()
+    op_x, inputs = gate_inputs.get(-x, (None, ()))
+    return tuple([-i for i in inputs]) if op_x is not None and op_x != op else ()
+
+def new_gate(key, op, inputs, bodies):
+    """Creates the literal of a gate, with a basic rule for each body."""
+    r = new_literal()
+    for body in bodies:
+        add_basic_rule(r, body)
+    set_tight(r, inputs)
+    gates[key] = r
+    if op is not None:
+        gate_inputs[r] = (op, inputs)
+    return r
+
+def and_gate(a, b):
+    """Returns the literal of a & b, given literals a and b."""
+    if active_model is not None: check_thread()
+    t, f = TRUE_BOOL.index, FALSE_BOOL.index
+    if a == f or b == f or a == -b:
+        save(1)
+        return f
+    if a == t or a == b:
+        save(1)
+        return b
+    if b == t:
+        save(1)
+        return a
+    for x, y in ((a, b), (b, a)):
+        if x < 0 and not is_tight(x, y):
+            continue  # ~~p isn't p in a loop
+        inputs = gate_view(x, 'and')
+        if y in inputs:  # (y & z) & y
+            save(1)
+            return x
+        if -y in inputs:  # (y & z) & ~y
+            save(1)
+            return f
+        if y in gate_view(x, 'or'):  # (y | z) & y
+            save(1)
+            return y
+    key = ('and', min(a, b), max(a, b))
+    if key in gates:
+        save(1)
+        return gates[key]
+    if ((a < 0 and b < 0 or is_tight(a, b)) and
+        ('or', min(-a, -b), max(-a, -b)) in gates):
+        save(1)
+        return -gates[('or', min(-a, -b), max(-a, -b))]
+    return new_gate(key, 'and', (a, b), [[a, b]])
+
+def or_gate(a, b):
+    """Returns the literal of a | b, given literals a and b."""
+    if active_model is not None: check_thread()
+    t, f = TRUE_BOOL.index, FALSE_BOOL.index
+    if a == t or b == t or (a == -b and is_tight(a)):
+        save(2)
+        return t
+    if a == f or a == b:
+        save(2)
+        return b
+    if b == f:
+        save(2)
+        return a
+    for x, y in ((a, b), (b, a)):
+        if x < 0 and not is_tight(x, y):
+            continue  # ~~p isn't p in a loop
+        inputs = gate_view(x, 'or')
+        if y in inputs:  # (y | z) | y
+            save(2)
+            return x
+        if -y in inputs and is_tight(x, y):  # (y | z) | ~y
+            save(2)
+            return t
+        if y in gate_view(x, 'and'):  # (y & z) | y
+            save(2)
+            return y
+    key = ('or', min(a, b), max(a, b))
+    if key in gates:
+        save(2)
+        return gates[key]
+    if ((a < 0 and b < 0 or is_tight(a, b)) and
+        ('and', min(-a, -b), max(-a, -b)) in gates):
+        save(2)
+        return -gates[('and', min(-a, -b), max(-a, -b))]
+    return new_gate(key, 'or', (a, b), [[a], [b]])
+
+def nary_gate(op, literals):
+    """Returns the literal of the and/or of a list of literals, with a
+    single rule for 'and' and one rule per literal for 'or'."""
+    if active_model is not None: check_thread()
+    t, f = TRUE_BOOL.index, FALSE_BOOL.index
+    unit, zero = (t, f) if op == 'and' else (f, t)
+    literals = sorted(set(literals) - set([unit]))
+    num_rules = 1 if op == 'and' else len(literals)
+    if zero in literals:
+        save(num_rules)
+        return zero
+    if not literals:
+        return unit
+    if len(literals) == 1:
+        return literals[0]
+    if len(literals) == 2:
+        return and_gate(*literals) if op == 'and' else or_gate(*literals)
+    opposed = set(literals) & set([-l for l in literals])
+    if opposed and (op == 'and' or is_tight(*opposed)):
+        save(num_rules)
+        return zero
+    key = (op,) + tuple(literals)
+    if key in gates:
+        save(num_rules)
+        return gates[key]
+    dual = ('or' if op == 'and' else 'and',) + tuple(sorted([-l for l in literals]))
+    if (all(l < 0 for l in literals) or is_tight(*literals)) and dual in gates:
+        save(num_rules)
+        return -gates[dual]
+    if op == 'and':
+        bodies = [literals]
+    else:
+        bodies = [[l] for l in literals]
+    return new_gate(key, op, tuple(literals), bodies)
+
+def eq_gate(a, b):
+    """Returns the literal of a == b, given literals a and b."""
+    if active_model is not None: check_thread()
+    t, f = TRUE_BOOL.index, FALSE_BOOL.index
+    if abs(a) > abs(b):
+        a, b = b, a
+    if a < 0:  # ~a == ~b has the same rules as a == b
+        a, b = -a, -b
+    if a == t:
+        save(2)
+        return b
+    if a == b and is_tight(a):
+        save(2)
+        return t
+    if a == -b:
+        save(2)
+        return f
+    key = ('eq', a, b)
+    if key in gates:
+        save(2)
+        return gates[key]
+    if ('eq', a, -b) in gates and is_tight(a, b):
+        save(2)
+        return -gates[('eq', a, -b)]
+    return new_gate(key, None, (a, b), [[a, b], [-a, -b]])
+
+def cond_gate(pred, cons, alt):
+    """Returns the literal of cons if pred else alt, given literals."""
+    t, f = TRUE_BOOL.index, FALSE_BOOL.index
+    if pred < 0:  # the rules are the same with ~pred, swapping cons and alt
+        pred, cons, alt = -pred, alt, cons
+    if pred == t or cons == alt:
+        save(2)
+        return cons
+    if alt == f:
+        save(1, 0)
+        return and_gate(pred, cons)
+    if cons == f:
+        save(1, 0)
+        return and_gate(-pred, alt)
+    if is_tight(pred, cons, alt):
+        if cons == t:
+            return or_gate(pred, alt)
+        if alt == t:
+            return or_gate(-pred, cons)
+    key = ('cond', pred, cons, alt)
+    if key in gates:
+        save(2)
+        return gates[key]
+    return new_gate(key, None, (pred, cons, alt), [[pred, cons], [-pred, alt]])
+
+def gate_result(index, *operands):
+    """Returns a BoolVar with the given index, which is one of the
+    operands if it has the same index."""
+    for x in operands:
+        if x.index == index:
+            return x
+    r = BoolVar('noinit')
+    r.index = index
+    return r
+
 # BoolVar is the root variable type, and represents a boolean that can
 # take on either value.  Every boolean has an index, starting at 2,
 # which is used when it's encoded to SMODELS internal representation.
@@ -363,6 +2319,8 @@ class BoolVar(object):
         from another type."""
         if val is None:
             self.index = new_literal()
+            visible[self.index] = 1
+            tight[self.index] = 1
             add_choice_rule([self.index], [])  # define the var with a choice rule
         elif val is 'internal':  # don't create a choice rule. (for internal use)
             self.index = new_literal()
@@ -373,8 +2331,9 @@ class BoolVar(object):
         elif type(val) is bool or type(val) is int:
             self.index = TRUE_BOOL.index if val else FALSE_BOOL.index
         elif type(val) is IntVar:
-            result = reduce(lambda a, b: a | b, val.bits)  # if any bits are non-zero
-            self.index = result.index
+            self.index = any_of(val.bits).index  # if any bits are non-zero
+        elif isinstance(val, IntVar):
+            self.index = (val != 0).index
         elif type(val) is MultiVar:
             # Use boolean_op to convert val to boolean because there's
             # no unary operator, and 'val != False' is inefficient.
@@ -386,9 +2345,9 @@ class BoolVar(object):
         return ('BoolVar', self.index)
     def value(self):
         if self.index > 0:
-            return self.index in solution
+            return literal_value(self.index)
         else:
-            return -self.index not in solution
+            return not literal_value(-self.index)
     def __repr__(self):
         return str(int(self.value()))
     def info(self):
@@ -399,44 +2358,21 @@ class BoolVar(object):
         r = BoolVar('noinit')
         r.index = -a.index
         return r
-    @memoized_symmetric
     def __eq__(a, b):
         b = BoolVar(b)
-        if b.index == TRUE_BOOL.index: return a  # opt
-        if b.index == FALSE_BOOL.index: return ~a  # opt
-        r = BoolVar('internal')
-        add_basic_rule(r.index, [a.index, b.index])
-        add_basic_rule(r.index, [-a.index, -b.index])
-        return r
+        return gate_result(eq_gate(a.index, b.index), a, b)
     def __ne__(a, b): return ~(a == b)
-    @memoized_symmetric
     def __and__(a, b):
         b = BoolVar(b)
-        if b.index == TRUE_BOOL.index: return a  # opt
-        if b.index == FALSE_BOOL.index: return FALSE_BOOL  # opt
-        r = BoolVar('internal')
-        add_basic_rule(r.index, [a.index, b.index])
-        return r
+        return gate_result(and_gate(a.index, b.index), a, b)
     __rand__ = __and__
-    @memoized_symmetric
     def __or__(a, b):
         b = BoolVar(b)
-        if b.index == TRUE_BOOL.index: return TRUE_BOOL  # opt
-        if b.index == FALSE_BOOL.index: return a  # opt
-        r = BoolVar('internal')
-        add_basic_rule(r.index, [a.index])
-        add_basic_rule(r.index, [b.index])
-        return r
+        return gate_result(or_gate(a.index, b.index), a, b)
     __ror__ = __or__
-    @memoized_symmetric
     def __xor__(a, b):
         b = BoolVar(b)
-        if b.index == TRUE_BOOL.index: return ~a  # opt
-        if b.index == FALSE_BOOL.index: return a  # opt
-        r = BoolVar('internal')
-        add_basic_rule(r.index, [a.index, -b.index])
-        add_basic_rule(r.index, [b.index, -a.index])
-        return r
+        return gate_result(eq_gate(a.index, -b.index), a, b)
     __rxor__ = __xor__
     @memoized
     def __gt__(a, b):
@@ -455,11 +2391,19 @@ class BoolVar(object):
     def cond(cons, pred, alt):
         pred = BoolVar(pred)
         alt = BoolVar(alt)
-        if cons.index == alt.index: return cons  # opt
-        result = BoolVar('internal')
-        add_basic_rule(result.index, [pred.index, cons.index])
-        add_basic_rule(result.index, [-pred.index, alt.index])
-        return result
+        return gate_result(cond_gate(pred.index, cons.index, alt.index), cons, alt)
+
+def all_of(bools):
+    """Returns a BoolVar indicating whether all of the given bools are
+    True, defined by a single rule."""
+    bools = map(BoolVar, bools)
+    return gate_result(nary_gate('and', [b.index for b in bools]), *bools)
+
+def any_of(bools):
+    """Returns a BoolVar indicating whether any of the given bools are
+    True, defined by one rule per bool."""
+    bools = map(BoolVar, bools)
+    return gate_result(nary_gate('or', [b.index for b in bools]), *bools)
 
 def at_least(n, bools):
     """Returns a BoolVar indicating whether at least n of the given
@@ -468,6 +2412,7 @@ def at_least(n, bools):
     bools = map(BoolVar, bools)
     result = BoolVar('internal')
     add_weight_rule(result.index, n, map(lambda x: x.index, bools))
+    set_tight(result.index, [b.index for b in bools])
     return result
 
 def at_most(n, bools):
@@ -489,6 +2434,7 @@ def sum_bools(n, bools):
 class Atom(BoolVar):
     def __init__(self):
         BoolVar.__init__(self, 'internal')
+        visible[self.index] = 1
     def prove_if(self, x):
         x = BoolVar(x)
         add_basic_rule(self.index, [x.index])
@@ -498,46 +2444,65 @@ class Atom(BoolVar):
 ##################################  Integers  ##################################
 ################################################################################
 
+# NUM_BITS is the default width of IntVars, when no range is given.
+# Each IntVar has its own number of bits and maximum value, and the
+# results of operations only allocate as many bits as they need, up to
+# the larger of NUM_BITS and the width of the operands.
 NUM_BITS = None
 BITS = None
 
 def set_bits(n):
-    """Sets the number of bits used for IntVars."""
+    """Sets the default number of bits used for IntVars."""
     global NUM_BITS, BITS
-    if last_bool > 2:  # true/false already defined
-        raise RuntimeError("Can't change number of bits after defining variables")
     print 'Setting integers to', n, 'bits'
     NUM_BITS = n
     BITS = range(NUM_BITS)
 
-def set_max_val(n):
-    """Sets the number of bits corresponding to maximum value n."""
+def num_bits(n):
+    """Returns the number of bits needed to represent value n."""
     i = 0
     while n >> i != 0:
         i += 1
-    set_bits(i)
+    return i
+
+def set_max_val(n):
+    """Sets the number of bits corresponding to maximum value n."""
+    set_bits(num_bits(n))
+
+def int_from_bits(bits, max_val=None):
+    """Creates an IntVar from a list of BoolVar bits, LSB first.
+    max_val is an upper bound on its value, if one is known."""
+    result = IntVar(0)  # don't allocate bools
+    result.bits = bits or [FALSE_BOOL]
+    result.max_val = (1 << len(result.bits)) - 1
+    if max_val is not None:
+        result.max_val = min(result.max_val, max_val)
+    return result
 
 def constrain_sum(a, b, result):
     """Constrain a + b == result.  Note that overflows are forbidden,
     even if the result is never used."""
     # This is a ripple-carry adder.
     c = False  # carry bit
+    n = max(len(a.bits), len(b.bits), len(result.bits))
     # Optimization: stop at the the necessary number of bits.
-    max_bit = max([i+1 for i in BITS if a.bits[i].index != FALSE_BOOL.index] +
-                  [i+1 for i in BITS if b.bits[i].index != FALSE_BOOL.index] +
-                  [i for i in BITS if result.bits[i].index != FALSE_BOOL.index])
-    for i in BITS:
-        d = (a.bits[i] ^ b.bits[i])
-        require(result.bits[i] == (d ^ c))
+    max_bit = max([i+1 for i in range(n) if a.bit(i).index != FALSE_BOOL.index] +
+                  [i+1 for i in range(n) if b.bit(i).index != FALSE_BOOL.index] +
+                  [i for i in range(n) if result.bit(i).index != FALSE_BOOL.index] + [0])
+    for i in range(n):
+        d = (a.bit(i) ^ b.bit(i))
+        require(result.bit(i) == (d ^ c))
         if i == max_bit:  # opt: we know the rest of the bits are false.
             return result
-        c = (a.bits[i] & b.bits[i]) | (d & c)
+        c = (a.bit(i) & b.bit(i)) | (d & c)
     require(~c)  # forbid overflows
     return result
 
 # IntVar is an integer variable, represented as a list of boolean variable bits.
 class IntVar(object):
     bits = []  # An array of BoolVar bits, LSB first.  Treat as immutable.
+    max_val = 0  # An upper bound on the value.  Treat as immutable.
+    min_val = 0  # A lower bound on the value.  Treat as immutable.
     def __init__(self, val=None, max_val=None):
         """Creates an integer variable.
         IntVar() : Can be any integer in the range of the number of bits.
@@ -548,34 +2513,54 @@ class IntVar(object):
         IntVar([1,2,3]) : An integer resticted to one of these values."""
         if val is None:
             self.bits = [BoolVar() for i in BITS]
+            self.max_val = (1 << NUM_BITS) - 1
         elif max_val is not None:
             if type(val) is not int or type(max_val) is not int:
                 raise RuntimeError('Expected two integers for IntVar() but got: ' +
                                    str(val) + ', ' + str(max_val))
             if max_val < val:
                 raise RuntimeError('Invalid integer range: ' + str(val) + ', ' + str(max_val))
-            if max_val >= (1 << NUM_BITS):
-                raise RuntimeError('Not enough bits to represent max value: ' + str(max_val))
-            self.bits = [(FALSE_BOOL if max_val >> i == 0 else BoolVar()) for i in BITS]
+            self.bits = [BoolVar() for i in range(num_bits(max_val))] or [FALSE_BOOL]
+            self.max_val = max_val
+            self.min_val = val
             if val > 0: require(self >= val)
-            require(self <= max_val)
-        elif type(val) is IntVar:
+            if max_val != (1 << len(self.bits)) - 1:
+                require(self <= max_val)
+        elif isinstance(val, IntVar):
             self.bits = val.bits
+            self.max_val = val.max_val
+            self.min_val = val.min_val
         elif isinstance(val, BoolVar):
-            self.bits = [val] + [FALSE_BOOL for i in BITS[1:]]
-        elif type(val) is int and val >> NUM_BITS == 0:
-            self.bits = [(TRUE_BOOL if ((val >> i) & 1) else FALSE_BOOL) for i in BITS]
+            self.bits = [val]
+            self.max_val = 1
+        elif type(val) is int and val >= 0:
+            self.bits = [(TRUE_BOOL if ((val >> i) & 1) else FALSE_BOOL)
+                         for i in range(num_bits(val))] or [FALSE_BOOL]
+            self.max_val = val
+            self.min_val = val
         elif type(val) is bool:
-            self.bits = [TRUE_BOOL if val else FALSE_BOOL] + [FALSE_BOOL for i in BITS[1:]]
+            self.bits = [TRUE_BOOL if val else FALSE_BOOL]
+            self.max_val = int(val)
+            self.min_val = int(val)
         elif type(val) is list:
-            self.bits = [BoolVar() for i in BITS]
-            require(reduce(lambda a, b: a | b, map(lambda x: self == x, val)))
+            self.bits = [BoolVar() for i in range(num_bits(max(val)))] or [FALSE_BOOL]
+            self.max_val = max(val)
+            self.min_val = min(val)
+            require(any_of([self == x for x in val]))
         else:
             raise TypeError("Can't convert to IntVar: " + str(val))
+    def bit(self, i):
+        """Returns bit i, which is false beyond the width of the IntVar."""
+        return self.bits[i] if i < len(self.bits) else FALSE_BOOL
     def hash_object(self):
-        return ('IntVar',) + tuple(map(lambda b: b.index, self.bits))
+        return ('IntVar', self.max_val) + tuple(map(lambda b: b.index, self.bits))
+    value_cache = None  # (solution_count, value) from the last call to value()
     def value(self):
-        return sum([(1 << i) for i in BITS if self.bits[i].value()])
+        if self.value_cache is None or self.value_cache[0] != solution_count:
+            bits = literal_values([b.index for b in self.bits])
+            self.value_cache = (solution_count,
+                                sum([1 << i for i in range(len(bits)) if bits[i]]))
+        return self.value_cache[1]
     def __repr__(self):
         return str(self.value())
     def info(self):
@@ -585,18 +2570,20 @@ class IntVar(object):
     def __eq__(self, x):
         try: x = IntVar(x)
         except TypeError: return NotImplemented
-        return reduce(lambda a, b: a & b,
-                      [self.bits[i] == x.bits[i] for i in BITS])
+        n = max(len(self.bits), len(x.bits))
+        return all_of([self.bit(i) == x.bit(i) for i in range(n)])
     def __ne__(self, x): return ~(self == x)
     @memoized_symmetric
     def __add__(self, x):
         try: x = IntVar(x)
         except TypeError: return NotImplemented
+        if x.max_val == 0: return self  # opt
+        if self.max_val == 0: return x  # opt
         # Optimization: only allocate the necessary number of bits.
-        max_bit = max([i for i in BITS if self.bits[i].index != FALSE_BOOL.index] +
-                      [i for i in BITS if x.bits[i].index != FALSE_BOOL.index] + [-1])
-        result = IntVar(0)  # don't allocate bools yet
-        result.bits = [(FALSE_BOOL if i > max_bit + 1 else BoolVar()) for i in BITS]
+        max_bits = max(NUM_BITS, len(self.bits), len(x.bits))
+        max_val = self.max_val + x.max_val
+        result = int_from_bits([BoolVar() for i in range(min(num_bits(max_val), max_bits))],
+                               max_val)
         constrain_sum(self, x, result)
         return result
     __radd__ = __add__
@@ -604,7 +2591,9 @@ class IntVar(object):
     def __sub__(self, x):
         try: x = IntVar(x)
         except TypeError: return NotImplemented
-        result = IntVar()
+        # The result is at most self.
+        result = int_from_bits([BoolVar() for i in range(num_bits(self.max_val))],
+                               self.max_val)
         constrain_sum(result, x, self)
         return result
     __rsub__ = __sub__
@@ -613,9 +2602,9 @@ class IntVar(object):
         try: x = IntVar(x)
         except TypeError: return NotImplemented
         result = FALSE_BOOL
-        for i in BITS:
-            result = cond(self.bits[i] > x.bits[i], TRUE_BOOL,
-                          cond(self.bits[i] < x.bits[i], FALSE_BOOL,
+        for i in range(max(len(self.bits), len(x.bits))):
+            result = cond(self.bit(i) > x.bit(i), TRUE_BOOL,
+                          cond(self.bit(i) < x.bit(i), FALSE_BOOL,
                                result))
         return result
     def __lt__(self, x): return IntVar(x) > self
@@ -624,29 +2613,27 @@ class IntVar(object):
     def cond(cons, pred, alt):
         pred = BoolVar(pred)
         alt = IntVar(alt)
-        result = IntVar(0)  # don't allocate bools yet
-        result.bits = map(lambda c, a: c.cond(pred, a),
-                          cons.bits, alt.bits)
-        return result
+        n = max(len(cons.bits), len(alt.bits))
+        return int_from_bits([cons.bit(i).cond(pred, alt.bit(i)) for i in range(n)],
+                             max(cons.max_val, alt.max_val))
     @memoized
     def __lshift__(self, i):
         assert type(i) is int
         if i == 0: return self
-        if i >= NUM_BITS: return IntVar(0)
-        result = IntVar(0)  # don't allocate bools
-        result.bits = [FALSE_BOOL for x in range(i)] + self.bits[:-i]
-        return result
+        # As with addition, the result is limited to max_bits.
+        max_bits = max(NUM_BITS, len(self.bits))
+        if i >= max_bits: return IntVar(0)
+        bits = [FALSE_BOOL for x in range(i)] + self.bits
+        return int_from_bits(bits[:max_bits], self.max_val << i)
     @memoized
     def __rshift__(self, i):
         assert type(i) is int
-        result = IntVar(0)  # don't allocate bools
-        result.bits = self.bits[i:] + [FALSE_BOOL for x in range(i)]
-        return result
+        return int_from_bits(self.bits[i:], self.max_val >> i)
     @memoized_symmetric
     def __mul__(self, x):
         x = IntVar(x)
         result = IntVar(0)
-        for i in BITS:
+        for i in range(len(x.bits)):
             result += cond(x.bits[i], self << i, 0)
         return result
 
@@ -662,7 +2649,11 @@ def cond(pred, cons, alt):
         (isinstance(alt, BoolVar) or type(alt) is bool)):
         cons = BoolVar(cons)
         return cons.cond(pred, alt)
-    if (type(cons) is IntVar or type(alt) is IntVar or
+    if type(cons) is DirectIntVar and type(alt) in (DirectIntVar, int):
+        return cons.cond(pred, alt)
+    if type(alt) is DirectIntVar and type(cons) is int:
+        return alt.cond(~pred, cons)
+    if (isinstance(cons, IntVar) or isinstance(alt, IntVar) or
         (type(cons) is int and type(alt) is int)):
         cons = IntVar(cons)
         return cons.cond(pred, alt)
@@ -671,30 +2662,500 @@ def cond(pred, cons, alt):
     return cons.cond(pred, alt)
 
 def require_all_diff(lst):
-    """Constrain all variables in the list to be different.  Note that
-    this creates O(N^2) rules."""
-    def choose(items, num):
-        """Returns an iterator over all choises of num elements from items."""
-        if len(items) < num or num <= 0:
-            yield items[:0]
-            return
-        if len(items) == num:
-            yield items
-            return
-        for x in choose(items[1:], num - 1):
-            yield items[:1] + x
-        for x in choose(items[1:], num):
-            yield x
-    for a, b in choose(lst, 2):
-        require(a != b)
+    """Constrain all variables in the list to be different.  Integers
+    and MultiVars are constrained with one at-most-one rule per value,
+    which is exactly-one if there are as many values as variables.
+    Other variables, and IntVars with many more possible values than
+    there are variables, are compared in pairs with O(N^2) rules."""
+    value_bools = all_diff_values(lst)
+    if value_bools is None:
+        for i in range(len(lst)):
+            for j in range(i + 1, len(lst)):
+                require(lst[i] != lst[j])
+        return
+    exact = len(value_bools) == len(lst)
+    for bools in value_bools:
+        bools = [b for b in bools if b.index != FALSE_BOOL.index]
+        indices = [b.index for b in bools]
+        if TRUE_BOOL.index in indices:  # a constant has this value
+            del bools[indices.index(TRUE_BOOL.index)]
+            for b in bools:
+                require(~b)
+            continue
+        if len(bools) > 1:  # at most one
+            add_constraint_rule(1, 2, [b.index for b in bools])
+        if exact:  # at least one
+            add_basic_rule(1, [-b.index for b in bools])
+
+def all_diff_values(lst):
+    """Returns a list with a list of BoolVars for each value, which is
+    whether each variable in lst has that value.  Returns None if the
+    variables should be compared in pairs instead."""
+    if all(isinstance(x, IntVar) or (type(x) is int and x >= 0) for x in lst):
+        binary = [x for x in lst
+                  if type(x) is not int and not isinstance(x, DomainIntVar)]
+        # check widths before listing values, which may be 2**32 of them
+        if any(x.max_val - x.min_val + 1 >= 2 * len(lst) for x in binary):
+            return None
+        domains = [set([x]) if type(x) is int else
+                   set(x.domain) if isinstance(x, DomainIntVar) else
+                   set(xrange(x.min_val, x.max_val + 1)) for x in lst]
+        domain = sorted(set().union(*domains))
+        if binary and len(domain) >= 2 * len(lst):
+            return None
+        def eq(x, v):
+            if type(x) is int:
+                return TRUE_BOOL if x == v else FALSE_BOOL
+            return x == v
+        return [[eq(x, v) for x, d in zip(lst, domains) if v in d]
+                for v in domain]
+    if any(type(x) is MultiVar for x in lst):
+        if any(isinstance(x, (BoolVar, IntVar)) for x in lst):
+            return None
+        lst = map(MultiVar, lst)
+        domain = set([v for x in lst for v in x.vals])
+        return [[x.vals[v] for x in lst if v in x.vals] for v in domain]
+    return None
 
 def sum_vars(lst):
+    """Sum a list of vars.  A sum of BoolVars, IntVars and integers is
+    a LinearSum, which is compared to constants and other IntVars with
+    weight rules.  Other lists are added with sum_tree."""
+    if len(lst) < 2:
+        return lst[0]
+    if (all(isinstance(x, (BoolVar, IntVar)) or (type(x) is int and x >= 0)
+            for x in lst) and
+        any(type(x) is not int for x in lst)):
+        return LinearSum([(1, x) for x in lst])
+    return sum_tree(lst)
+
+def sum_tree(lst):
     """Sum a list of vars, using a tree.  This is often more efficient
     than adding in sequence, as bits can be saved."""
     if len(lst) < 2:
         return lst[0]
     middle = len(lst) // 2
-    return sum_vars(lst[:middle]) + sum_vars(lst[middle:])
+    return sum_tree(lst[:middle]) + sum_tree(lst[middle:])
+
+
+################################################################################
+############################  Direct and order ints  ###########################
+################################################################################
+
+# For small domains, an integer can be encoded with one boolean per
+# value (DirectIntVar) or one boolean per bound x >= v (OrderIntVar),
+# instead of in binary.  Comparisons with constants and between these
+# variables then only need a literal or a single rule.  Both are
+# IntVars: for arithmetic and comparisons with other IntVars, the
+# binary bits are derived from the encoding the first time they're used.
+class DomainIntVar(IntVar):
+    domain = []  # The sorted possible values.  Treat as immutable.
+    bools = []  # The BoolVars of the encoding.  Treat as immutable.
+    bits_cache = None  # The binary bits, once derived.
+    @property
+    def min_val(self):
+        return self.domain[0]
+    def __init__(self, val=None, max_val=None):
+        if val is None:
+            raise TypeError(type(self).__name__ + '() needs a range or a list of values')
+        if max_val is not None:
+            if type(val) is not int or type(max_val) is not int:
+                raise RuntimeError('Expected two integers for ' + type(self).__name__ +
+                                   '() but got: ' + str(val) + ', ' + str(max_val))
+            domain = range(val, max_val + 1)
+        elif type(val) is int:
+            domain = [val]
+        elif type(val) is list:
+            domain = sorted(set(val))
+        else:
+            raise TypeError("Can't convert to " + type(self).__name__ + ": " + str(val))
+        if not domain or domain[0] < 0 or any(type(v) is not int for v in domain):
+            raise RuntimeError('Invalid domain: ' + str(val) + ', ' + str(max_val))
+        self.domain = domain
+        self.max_val = domain[-1]
+        self.encode()
+    @classmethod
+    def unencoded(cls, domain):
+        """Returns a variable with the given domain, whose bools are
+        set by the caller, for internal use."""
+        result = object.__new__(cls)
+        result.domain = domain
+        result.max_val = domain[-1]
+        return result
+    def hash_object(self):
+        return ((type(self).__name__, tuple(self.domain)) +
+                tuple(map(lambda b: b.index, self.bools)))
+    @property
+    def bits(self):
+        """The binary bits, derived from the equality literals."""
+        if self.bits_cache is None:
+            self.bits_cache = []
+            for i in range(num_bits(self.max_val)):
+                terms = [self.eq_bool(v) for v in self.domain if (v >> i) & 1]
+                self.bits_cache.append(FALSE_BOOL if not terms else
+                                       terms[0] if len(terms) == 1 else
+                                       at_least(1, terms))
+            self.bits_cache = self.bits_cache or [FALSE_BOOL]
+        return self.bits_cache
+    def value(self):
+        if self.value_cache is None or self.value_cache[0] != solution_count:
+            bits = literal_values([b.index for b in self.bools])
+            self.value_cache = (solution_count, self.decode(bits))
+        return self.value_cache[1]
+    def info(self):
+        return (type(self).__name__ + '[' +
+                ','.join([str(v) + ':' + str(self.eq_bool(v)) for v in self.domain]) +
+                ']=' + str(self))
+    @memoized_symmetric
+    def __eq__(self, x):
+        if type(x) is int or type(x) is bool:
+            return self.eq_bool(int(x))
+        if isinstance(x, DomainIntVar):
+            terms = [self.eq_bool(v) & x.eq_bool(v)
+                     for v in self.domain if v in x.domain]
+            if len(terms) > 1:
+                return at_least(1, terms)
+            return terms[0] if terms else FALSE_BOOL
+        return IntVar(self) == x
+    @memoized
+    def __gt__(self, x):
+        if type(x) is int or type(x) is bool:
+            return self.ge_bool(int(x) + 1)
+        # Both must be plain IntVars, or Python would call x.__lt__.
+        return IntVar(self) > IntVar(x)
+    @memoized
+    def __lt__(self, x):
+        if type(x) is int or type(x) is bool:
+            return ~self.ge_bool(int(x))
+        return IntVar(x) > IntVar(self)
+
+class DirectIntVar(DomainIntVar):
+    """DirectIntVar(1,9) : An integer in range 1 to 9, with a boolean
+    for each value.
+    DirectIntVar([1,2,3]) : An integer restricted to one of these values."""
+    def encode(self):
+        if len(self.domain) == 1:
+            self.bools = [TRUE_BOOL]
+            return
+        self.bools = [BoolVar('internal') for v in self.domain]
+        for b in self.bools:
+            visible[b.index] = 1
+            tight[b.index] = 1
+        # The last value is true if no other one is, so exactly one
+        # value only takes a single cardinality rule.
+        others = [b.index for b in self.bools[:-1]]
+        add_choice_rule(others, [])
+        add_basic_rule(self.bools[-1].index, [-i for i in others])
+        if len(others) > 1:
+            add_constraint_rule(1, 2, others)
+    def eq_bool(self, v):
+        if v not in self.domain:
+            return FALSE_BOOL
+        return self.bools[self.domain.index(v)]
+    @memoized
+    def ge_bool(self, v):
+        above = [b for d, b in zip(self.domain, self.bools) if d >= v]
+        below = [b for d, b in zip(self.domain, self.bools) if d < v]
+        if not above: return FALSE_BOOL
+        if not below: return TRUE_BOOL
+        if len(above) == 1: return above[0]
+        if len(below) == 1: return ~below[0]
+        if len(below) < len(above):
+            return ~at_least(1, below)
+        return at_least(1, above)
+    def decode(self, bits):
+        return self.domain[bits.index(1)] if 1 in bits else '???'
+    def cond(cons, pred, alt):
+        """If alt is also a DirectIntVar or an integer, the result is
+        a DirectIntVar."""
+        if type(alt) is int:
+            alt = DirectIntVar(alt)
+        if type(alt) is not DirectIntVar:
+            return IntVar(cons).cond(pred, alt)
+        pred = BoolVar(pred)
+        result = DirectIntVar.unencoded(sorted(set(cons.domain + alt.domain)))
+        result.bools = [cons.eq_bool(v).cond(pred, alt.eq_bool(v))
+                        for v in result.domain]
+        return result
+
+class OrderIntVar(DomainIntVar):
+    """OrderIntVar(1,9) : An integer in range 1 to 9, with a boolean
+    for each bound x >= v.
+    OrderIntVar([1,2,3]) : An integer restricted to one of these values."""
+    def encode(self):
+        # bools[k] is whether the value is at least domain[k+1].
+        self.bools = [BoolVar('internal') for v in self.domain[1:]]
+        for b in self.bools:
+            visible[b.index] = 1
+            tight[b.index] = 1
+        if self.bools:
+            add_choice_rule([b.index for b in self.bools], [])
+        for a, b in zip(self.bools, self.bools[1:]):
+            add_basic_rule(1, [b.index, -a.index])  # b implies a
+    def bound(self, k):
+        """Whether the value is at least domain[k]."""
+        if k <= 0: return TRUE_BOOL
+        if k >= len(self.domain): return FALSE_BOOL
+        return self.bools[k - 1]
+    def eq_bool(self, v):
+        if v not in self.domain:
+            return FALSE_BOOL
+        k = self.domain.index(v)
+        return self.bound(k) & ~self.bound(k + 1)
+    def ge_bool(self, v):
+        return self.bound(len([d for d in self.domain if d < v]))
+    def decode(self, bits):
+        return self.domain[sum(bits)]
+
+def count(bools):
+    """Returns the number of true booleans, as an OrderIntVar.  Its
+    comparisons with constants are single literals, which are shared
+    by every call with the same booleans."""
+    return totalizer(*map(BoolVar, bools))
+
+@memoized
+def totalizer(*bools):
+    """Counts bools in unary with a totalizer: a tree of merges, where
+    output k of each merge is whether at least k inputs are true."""
+    result = OrderIntVar.unencoded(range(len(bools) + 1))
+    if len(bools) < 2:
+        result.bools = list(bools)
+        return result
+    middle = len(bools) // 2
+    a = totalizer(*bools[:middle]).bools
+    b = totalizer(*bools[middle:]).bools
+    result.bools = [BoolVar('internal') for x in bools]
+    for i in range(len(a) + 1):
+        for j in range(len(b) + 1):
+            if i + j > 0:
+                add_basic_rule(result.bools[i + j - 1].index,
+                               [a[i - 1].index] * (i > 0) + [b[j - 1].index] * (j > 0))
+    return result
+
+
+################################################################################
+##############################  Linear constraints  ############################
+################################################################################
+
+# A linear constraint over BoolVars and IntVars is compiled to a single
+# weight rule, with a weight for each bit, instead of a tree of adders
+# and a comparator.  Negative weights are encoded by negating the
+# literal and adjusting the bound.
+
+def linear_terms(x):
+    """Returns the weighted literals of a variable, as a list of
+    (weight, BoolVar) pairs, and a constant offset."""
+    if type(x) is int or type(x) is bool:
+        return [], int(x)
+    elif isinstance(x, BoolVar):
+        return [(1, x)], 0
+    elif type(x) is DirectIntVar:
+        return zip(x.domain, x.bools), 0
+    elif isinstance(x, OrderIntVar):
+        return zip([b - a for a, b in zip(x.domain, x.domain[1:])], x.bools), x.domain[0]
+    elif type(x) is LinearSum:
+        terms = []
+        offset = x.offset
+        for c, v in x.terms:
+            v_terms, v_offset = linear_terms(v)
+            terms.extend([(c * w, b) for w, b in v_terms])
+            offset += c * v_offset
+        return terms, offset
+    elif isinstance(x, IntVar):
+        return [(1 << i, b) for i, b in enumerate(x.bits)], 0
+    raise TypeError("Can't use in a linear constraint: " + str(x))
+
+def linear_ge(coeffs, vars, k):
+    """Returns a BoolVar indicating whether the sum of coeffs[i] * vars[i]
+    is at least k.  The coefficients and k must be integers."""
+    assert type(k) is int
+    literals = []
+    weights = []
+    for c, v in zip(coeffs, vars):
+        assert type(c) is int
+        terms, offset = linear_terms(v)
+        k -= c * offset
+        for w, b in terms:
+            w *= c
+            if w == 0 or b.index == FALSE_BOOL.index:
+                continue
+            if b.index == TRUE_BOOL.index:
+                k -= w
+            elif w > 0:
+                literals.append(b.index)
+                weights.append(w)
+            else:  # w * b == w + (-w) * ~b
+                k -= w
+                literals.append(-b.index)
+                weights.append(-w)
+    if k <= 0: return TRUE_BOOL  # opt
+    if k > sum(weights): return FALSE_BOOL  # opt
+    result = BoolVar('internal')
+    add_weight_rule(result.index, k, literals, weights)
+    set_tight(result.index, literals)
+    return result
+
+def linear_le(coeffs, vars, k):
+    """Returns a BoolVar indicating whether the sum of coeffs[i] * vars[i]
+    is at most k."""
+    return linear_ge([-c for c in coeffs], vars, -k)
+
+def linear_eq(coeffs, vars, k):
+    """Returns a BoolVar indicating whether the sum of coeffs[i] * vars[i]
+    is equal to k."""
+    return linear_ge(coeffs, vars, k) & linear_le(coeffs, vars, k)
+
+# LinearSum is the result of sum_vars: a sum of variables with
+# non-negative coefficients.  Comparisons with constants and other
+# IntVars are linear constraints, and the binary bits are only built
+# with adders if the sum is used in other arithmetic.
+class LinearSum(IntVar):
+    terms = []  # list of (coefficient, variable).  Treat as immutable.
+    offset = 0
+    bits_cache = None  # The binary bits, once built.
+    def __init__(self, terms, offset=0):
+        self.terms = terms
+        self.offset = offset
+        self.max_val = offset + sum([c * (1 if isinstance(v, BoolVar) else
+                                          v if type(v) is int else v.max_val)
+                                     for c, v in terms])
+    def hash_object(self):
+        return ('LinearSum', self.offset) + tuple([(c, hash_object(v))
+                                                   for c, v in self.terms])
+    @property
+    def bits(self):
+        """The binary bits, built with adders when first used."""
+        if self.bits_cache is None:
+            parts = [IntVar(v) if c == 1 else IntVar(v) * c for c, v in self.terms]
+            if self.offset:
+                parts.append(IntVar(self.offset))
+            self.bits_cache = sum_tree(parts).bits
+        return self.bits_cache
+    def value(self):
+        if self.value_cache is None or self.value_cache[0] != solution_count:
+            vals = values([v for c, v in self.terms])
+            self.value_cache = (solution_count, self.offset +
+                                sum([c * int(x) for (c, v), x in zip(self.terms, vals)]))
+        return self.value_cache[1]
+    def info(self):
+        return ('LinearSum[' + ' + '.join([str(c) + '*' + str(v) for c, v in self.terms] +
+                                          [str(self.offset)]) + ']=' + str(self))
+    def difference(self, x):
+        """Returns the coefficients and variables of self - x, without
+        the offset."""
+        return ([c for c, v in self.terms] + [-1], [v for c, v in self.terms] + [x])
+    def is_linear(self, x):
+        return type(x) in (int, bool) or isinstance(x, (BoolVar, IntVar))
+    @memoized_symmetric
+    def __eq__(self, x):
+        if not self.is_linear(x): return NotImplemented
+        coeffs, vars = self.difference(x)
+        return linear_eq(coeffs, vars, -self.offset)
+    @memoized
+    def __gt__(self, x):
+        if not self.is_linear(x): return NotImplemented
+        coeffs, vars = self.difference(x)
+        return linear_ge(coeffs, vars, 1 - self.offset)
+    @memoized
+    def __lt__(self, x):
+        if not self.is_linear(x): return NotImplemented
+        coeffs, vars = self.difference(x)
+        return linear_le(coeffs, vars, -1 - self.offset)
+    def __add__(self, x):
+        if type(x) is LinearSum:
+            return LinearSum(self.terms + x.terms, self.offset + x.offset)
+        if type(x) in (int, bool) and x >= 0:
+            return LinearSum(self.terms, self.offset + int(x))
+        if isinstance(x, (BoolVar, IntVar)):
+            return LinearSum(self.terms + [(1, x)], self.offset)
+        return NotImplemented
+    __radd__ = __add__
+    def __mul__(self, x):
+        if type(x) is int and x >= 0:
+            return LinearSum([(c * x, v) for c, v in self.terms], self.offset * x)
+        return IntVar(self) * x
+    __rmul__ = __mul__
+
+
+################################################################################
+#################################  Optimization  ###############################
+################################################################################
+
+# minimize() and maximize() add objectives, which are written after
+# the rules as SMODELS minimize statements, so that clasp's optimizer
+# finds an optimal solution in a single run.  Each objective is kept
+# as a sum of positive weights on literals, plus an offset.  clasp
+# gives the last statement the highest priority, so the statements are
+# written in reverse, and the first objective is the most important.
+
+objectives = None  # list of (sign, offset, literals, weights)
+optimal = False  # whether the last solution was proven optimal
+
+def objective_terms(x):
+    """Returns an integer expression as a constant and a list of
+    (coefficient, BoolVar) terms.  A list is summed, and may contain
+    (coefficient, expression) pairs."""
+    if type(x) in (int, long, bool):
+        return int(x), []
+    if isinstance(x, BoolVar):
+        return 0, [(1, x)]
+    if type(x) is DirectIntVar:
+        return 0, zip(x.domain, x.bools)
+    if type(x) is OrderIntVar:
+        steps = [b - a for a, b in zip(x.domain, x.domain[1:])]
+        return x.domain[0], zip(steps, x.bools)
+    if type(x) is IntVar:
+        return 0, [(1 << i, b) for i, b in enumerate(x.bits)]
+    if type(x) in (list, tuple, LinearSum):
+        offset, terms = 0, []
+        items = x.terms if type(x) is LinearSum else x
+        for item in items:
+            c, y = item if type(item) is tuple else (1, item)
+            y_offset, y_terms = objective_terms(y)
+            offset += c * y_offset
+            terms += [(c * d, b) for d, b in y_terms]
+        if type(x) is LinearSum:
+            offset += x.offset
+        return offset, terms
+    raise TypeError("Can't optimize: " + str(x))
+
+def add_objective(sign, x):
+    """Adds an objective to minimize sign * x."""
+    offset, terms = objective_terms(x)
+    offset *= sign
+    literals, weights = [], []
+    for c, b in terms:
+        c *= sign
+        if c < 0:  # c*b = c + |c|*~b
+            offset += c
+            c, b = -c, ~b
+        if c > 0 and b.index != -TRUE_BOOL.index:
+            literals.append(b.index)
+            weights.append(c)
+    objectives.append((sign, offset, literals, weights))
+
+def minimize(x):
+    """Makes solve() find a solution where the integer expression x is
+    as small as possible.  x may also be a list of expressions or of
+    (weight, expression) pairs, which are summed.  With several
+    objectives, the first has priority."""
+    add_objective(1, x)
+
+def maximize(x):
+    """Makes solve() find a solution where x is as large as possible."""
+    add_objective(-1, x)
+
+def minimize_statements():
+    """Returns the text of the minimize statements of the objectives."""
+    # format: 6 0 #literals #negative [negative] [positive] [weights]
+    # which is a weight rule without the head and bound.
+    return ''.join([' '.join(map(str, [6, 0] + weight_rule_vals(0, 0, literals, weights)[3:])) + '\n'
+                    for sign, offset, literals, weights in reversed(objectives)])
+
+def objective_values():
+    """Returns the value of each objective in the solution."""
+    return [sign * (offset + sum([w for w, v in zip(weights, literal_values(literals)) if v]))
+            for sign, offset, literals, weights in objectives]
 
 
 ################################################################################
@@ -721,7 +3182,7 @@ class MultiVar(object):
                 self.vals = {values[0]:TRUE_BOOL}
             return
         for v in values:
-            if isinstance(v, BoolVar) or type(v) is IntVar or type(v) is MultiVar:
+            if isinstance(v, BoolVar) or isinstance(v, IntVar) or type(v) is MultiVar:
                 raise RuntimeException("Can't convert other variables to MultiVar")
         # TODO: optimize two-value case to single boolean
         for v in set(values):
@@ -730,11 +3191,15 @@ class MultiVar(object):
         require(sum_bools(1, self.vals.values()))
     def hash_object(self):
         return ('MultiVar',) + tuple(map(lambda (v,b): (v, b.index), self.vals.iteritems()))
+    value_cache = None  # (solution_count, value) from the last call to value()
     def value(self):
-        for v, b in self.vals.iteritems():
-            if b.value():
-                return v
-        return '???'  # unknown
+        if self.value_cache is None or self.value_cache[0] != solution_count:
+            self.value_cache = (solution_count, '???')  # unknown
+            for v, b in self.vals.iteritems():
+                if b.value():
+                    self.value_cache = (solution_count, v)
+                    break
+        return self.value_cache[1]
     def __repr__(self):
         return str(self.value())
     def info(self):
@@ -763,7 +3228,7 @@ class MultiVar(object):
                 term = op(a_val, b_val) ^ invert
                 terms.append(cond(term, a_bool & b_bool, False))
         if terms:
-            result = reduce(lambda a, b: a | b, terms)
+            result = any_of(terms)
             # Subtle bug: this must be cast to BoolVar,
             # otherwise we might compute ~True for __ne__ below.
             return BoolVar(result) ^ invert
@@ -774,15 +3239,14 @@ class MultiVar(object):
         if type(b) is not MultiVar:
             b = MultiVar(b)
         result = MultiVar()
+        terms = {}  # dictionary from value to the bools for that value
         for a_val, a_bool in a.vals.iteritems():
             for b_val, b_bool in b.vals.iteritems():
                 result_val = op(a_val, b_val)
-                result_bool = a_bool & b_bool
                 # TODO: make this work for b as a variable
-                if result_val in result.vals:
-                    result.vals[result_val] = result.vals[result_val] | result_bool
-                else:
-                    result.vals[result_val] = result_bool
+                terms.setdefault(result_val, []).append(a_bool & b_bool)
+        for result_val, bools in terms.iteritems():
+            result.vals[result_val] = any_of(bools)
         return result
     @memoized_symmetric
     def __eq__(a, b): return a.boolean_op(lambda x, y: x == y, b)
@@ -817,7 +3281,7 @@ class MultiVar(object):
         return result
 
 def var_in(v, lst):
-    return reduce(lambda a,b: a|b, map(lambda x: v == x, lst))
+    return any_of([v == x for x in lst])
 
 
 # initialize on startup
@@ -90,17 +90,11 @@ for r in range(height):
     for c in range(width):
         require(cond(flow[r][c] == '.', group[r][c] == r*width + c, True))
 
-# Loop to find all solutions.
-while solve():
+# Find all solutions, distinguished by the grid values.
+for _ in iter_solutions(project=grid):
     print 'solution:'
     for r in range(height):
         for c in range(width):
             print str(grid[r][c]).rjust(2),
         print
     print
-    # Once a solution is found, add a constraint eliminating it.
-    x = BoolVar(True)
-    for r in range(9):
-        for c in range(9):
-            x = x & (grid[r][c] == grid[r][c].value())
-    require(~x)
@@ -74,8 +74,8 @@ for r in range(height):
                 conn_grid[r][c].prove_if(conn_grid[r1][c1] & ~fill_grid[r1][c1])
         require(conn_grid[r][c])
 
-# Loop to find all solutions.
-while solve():
+# Find all solutions, distinguished by the fill grid values.
+for _ in iter_solutions(project=fill_grid):
     print 'solution:'
     for r in range(height):
         for c in range(width):
@@ -85,9 +85,3 @@ while solve():
                 print str(puzzle[r][c]).rjust(2),
         print
     print
-    # Once a solution is found, add a constraint eliminating it.
-    x = BoolVar(True)
-    for r in range(9):
-        for c in range(9):
-            x = x & (fill_grid[r][c] == fill_grid[r][c].value())
-    require(~x)
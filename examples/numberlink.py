@@ -46,14 +46,8 @@ for r in range(height):
         else:
             require(sum_bools(1, same_neighbors))
 
-# Loop to find all solutions.
-while solve():
+# Find all solutions, distinguished by the grid values.
+for _ in iter_solutions(project=grid):
     print 'solution:'
     print '\n'.join([' '.join(map(str, row)) for row in grid])
     print
-    # Once a solution is found, add a constraint eliminating it.
-    x = BoolVar(True)
-    for r in range(9):
-        for c in range(9):
-            x = x & (grid[r][c] == grid[r][c].value())
-    require(~x)
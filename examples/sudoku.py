@@ -37,14 +37,8 @@ for r in range(0,9,3):
         require_all_diff([grid[r+i][c+j] for (i,j) in
                           itertools.product(range(3), range(3))])
 
-# Loop to find all solutions.
-while solve():
+# Find all solutions, distinguished by the grid values.
+for _ in iter_solutions(project=grid):
     print 'solution:'
     print '\n'.join([' '.join(map(str, row)) for row in grid])
     print
-    # Once a solution is found, add a constraint eliminating it.
-    x = BoolVar(True)
-    for r in range(9):
-        for c in range(9):
-            x = x & (grid[r][c] == grid[r][c].value())
-    require(~x)
@@ -2,6 +2,7 @@
 #
 # Unit tests for claspy.
 
+import claspy
 from claspy import *
 
 ########## BoolVars ##########
@@ -228,10 +229,89 @@ a = BoolVar(0)
 solve()
 assert a.value() == False
 
+#### gate hashing
+
+reset()
+a = BoolVar()
+b = BoolVar()
+rules = len(claspy.rule_starts)
+assert (a & ~a).index == FALSE_BOOL.index
+assert (a | ~a).index == TRUE_BOOL.index
+assert (a == a).index == TRUE_BOOL.index
+assert (a ^ a).index == FALSE_BOOL.index
+assert (True & a).index == a.index
+assert len(claspy.rule_starts) == rules
+c = a & b
+assert (c & a).index == c.index
+assert (b & a).index == c.index
+assert (~a | ~b).index == (~c).index
+d = a | b
+assert (~(~a & ~b)).index == d.index
+assert (d & b).index == b.index
+assert (a ^ b).index == (a == ~b).index
+assert (a ^ b).index == (~a ^ ~b).index
+assert (a ^ b).index == (~(a == b)).index
+assert len(claspy.rule_starts) - rules == 5
+assert claspy.saved_rules > 0
+require(~c)
+require(d)
+require(a)
+solve()
+assert (a.value(), b.value(), c.value(), d.value()) == (True, False, False, True)
+
+#### all_of, any_of
+
+reset()
+xs = [BoolVar() for i in range(5)]
+rules = len(claspy.rule_starts)
+a = all_of(xs)
+b = any_of(xs)
+assert len(claspy.rule_starts) - rules == 6
+assert all_of(reversed(xs)).index == a.index
+assert (~any_of(map(lambda x: ~x, xs))).index == a.index
+assert all_of(xs + [~xs[2]]).index == FALSE_BOOL.index
+assert any_of(xs[:1] + [False]).index == xs[0].index
+assert all_of([]).index == TRUE_BOOL.index
+assert any_of([]).index == FALSE_BOOL.index
+require(b)
+require(~a)
+require(at_most(1, xs))
+require(~xs[0] & ~xs[1] & ~xs[2] & ~xs[4])
+solve()
+assert values(xs) == [False, False, False, True, False]
+assert (a.value(), b.value()) == (False, True)
+
+# atoms can be in positive loops, so a | ~a is not always true
+reset()
+a = Atom()
+b = a | ~a
+assert b.index != TRUE_BOOL.index
+a.prove_if(b)
+assert not solve()
+
+# nor is ~~a the same as a
+reset()
+a = Atom()
+b = BoolVar()
+c = ~(~(a | b) | ~a)
+assert c.index != a.index
+a.prove_if(c)
+require(~b)
+require(a)
+assert solve()
+
 
 ########## IntVars ##########
 
 #### eq
+
+# one gate for the equality of each bit, and one for all of them
+reset()
+a = IntVar(0,255)
+b = IntVar(0,255)
+rules = len(claspy.rule_starts)
+c = a == b
+assert len(claspy.rule_starts) - rules == 17
 reset()
 a = IntVar()
 b = IntVar()
@@ -440,6 +520,53 @@ assert a.value() != b.value()
 assert a.value() != c.value()
 assert b.value() != c.value()
 
+# one rule per value, instead of comparing every pair
+reset()
+xs = [IntVar(1,9) for i in range(9)]
+require_all_diff(xs)
+require(xs[0] == 5)
+require(xs[1] < 2)
+solve()
+assert sorted(values(xs)) == range(1,10)
+assert xs[0].value() == 5
+assert xs[1].value() == 1
+
+reset()
+xs = [DirectIntVar(1,4) for i in range(4)]
+rules = len(claspy.rule_starts)
+require_all_diff(xs)
+assert len(claspy.rule_starts) - rules == 8
+require_all_diff(xs[:3] + [3])
+require(xs[0] > xs[1])
+require(xs[1] > xs[2])
+solve()
+assert values(xs) == [4, 2, 1, 3]
+
+reset()
+a = IntVar(1,3)
+b = OrderIntVar([1,2,3])
+require_all_diff([a, b, 2, IntVar(4)])
+require(a > b)
+solve()
+assert (a.value(), b.value()) == (3, 1)
+
+reset()
+a = MultiVar('x','y','z')
+b = MultiVar('x','y')
+require_all_diff([a, b, 'x'])
+solve()
+assert (a.value(), b.value()) == ('z', 'y')
+
+# wide IntVars are compared in pairs, without listing their values
+reset()
+xs = [IntVar(0,10**9) for i in range(3)]
+require_all_diff(xs)
+require(xs[0] == 0)
+require(xs[1] < 2)
+require(xs[2] < 3)
+solve()
+assert values(xs) == [0, 1, 2]
+
 #### sum_vars
 
 reset()
@@ -448,6 +575,49 @@ solve()
 assert a.value() == 46
 
 
+######## Simplification ########
+
+reset()
+set_simplify()
+a = BoolVar()
+b = BoolVar()
+c = IntVar(0,7)
+d = IntVar(0,7)
+e = Atom()
+unused = (a ^ b) & (c > d)  # not used by any constraint
+require(a | b)
+require(a)
+require(at_least(1, [a, b]))  # satisfied by a
+require(c > 3)
+e.prove_if(b)
+e.prove_if(b)
+solve()
+assert claspy.simplify_stats['unreachable'] >= 3
+assert claspy.simplify_stats['satisfied'] >= 2
+assert claspy.simplify_stats['duplicate'] == 1
+assert a.value() == True
+assert c.value() > 3
+assert e.value() == b.value()
+assert unused.value() == (not b.value() and c.value() > d.value())
+require(c == d)
+require(c < 5)
+assert [x for _ in iter_solutions(project=[c, d]) for x in values([c, d])] == [4, 4]
+require(~b)
+require(~a)
+assert not solve()
+set_simplify(False)
+
+# a required atom can't support itself
+reset()
+set_simplify()
+a = Atom()
+b = BoolVar()
+a.prove_if(a & b)
+require(a)
+assert not solve()
+set_simplify(False)
+
+
 ######## MultiVars ########
 
 reset()
@@ -588,5 +758,867 @@ a = MultiVar('x')
 require(a != 'x')
 assert not solve()
 
+######## Named literals ########
+
+# internal gates are not named, and are computed from the solution
+reset()
+a = BoolVar()
+b = BoolVar()
+c = at_least(1, [a, b]) & ~(a == b)
+d = (a | b) ^ c
+e = cond(d, IntVar(3), IntVar(5))
+require(a)
+require(~b)
+solve()
+assert c.value() == True
+assert d.value() == False
+assert e.value() == 5
+
+reset()
+a = BoolVar()
+b = a & BoolVar()
+show(b)
+require(b)
+solve()
+assert a.value() == True
+assert b.value() == True
+
+######## Bulk values ########
+
+reset()
+grid = [[IntVar(0,9) for c in range(3)] for r in range(2)]
+for r in range(2):
+    for c in range(3):
+        require(grid[r][c] == r * 3 + c)
+mixed = [BoolVar(True), grid[1][1] > 3, MultiVar('x'), 7]
+solve()
+assert values(grid) == [[0,1,2],[3,4,5]]
+assert values(mixed) == [True, True, 'x', 7]
+if numpy is not None:
+    assert values(grid, as_array=True).tolist() == [[0,1,2],[3,4,5]]
+    assert values(grid, as_array=True).shape == (2,3)
+# without NumPy, as_array is an error, and values are decoded without it
+saved_numpy, claspy.numpy = claspy.numpy, None
+try:
+    values(grid, as_array=True)
+    assert False
+except ImportError:
+    pass
+assert values(grid) == [[0,1,2],[3,4,5]]
+claspy.numpy = saved_numpy
+
+######## Enumeration ########
+
+reset()
+a = IntVar(0,3)
+b = IntVar(0,3)
+require(a + b == 3)
+found = set()
+for _ in iter_solutions():
+    found.add((a.value(), b.value()))
+assert found == set([(0,3), (1,2), (2,1), (3,0)])
+
+reset()
+a = IntVar(0,3)
+b = IntVar(0,3)
+require(a + b == 3)
+assert len(list(iter_solutions(limit=2))) == 2
+
+# projection onto a, with b free
+reset()
+a = IntVar(0,2)
+b = IntVar(0,2)
+require(a < 2)
+assert sorted([a.value() for _ in iter_solutions(project=[a])]) == [0, 1]
+
+# counting
+reset()
+a = IntVar(0,3)
+b = IntVar(0,3)
+require(a + b == 3)
+assert count_solutions() == 2
+assert count_solutions(limit=None) == 4
+assert count_solutions(limit=None, project=[a]) == 4
+assert count_solutions(project=[a], assume=[a > 2]) == 1
+require(a < b)
+assert count_solutions(limit=10, project=[a]) == 2
+require(b == 0)
+assert count_solutions() == 0
+# objectives are ignored
+reset()
+a = IntVar(0,3)
+minimize(a)
+assert count_solutions(limit=None) == 4
+# simplification keeps the variables that no constraint reaches
+reset()
+set_simplify()
+a = BoolVar()
+b = BoolVar()
+c = BoolVar()
+require(a | b)
+assert count_solutions(limit=None) == 6
+assert count_solutions(limit=None, project=[a, b]) == 3
+set_simplify(False)
+
+######## Consequences ########
+
+reset()
+a = IntVar(1,9)
+b = DirectIntVar(1,9)
+c = MultiVar('x','y','z')
+d = BoolVar()
+e = BoolVar()
+require(a + b == 10)
+require(a > 6)
+require(c != 'x')
+require(d == (a == 9))
+require(e)
+assert possible_values(a) == set([7, 8, 9])
+assert possible_values([[b], c, d, e]) == [[set([1, 2, 3])], set(['y', 'z']), set([False, True]), set([True])]
+assert forced_values([a, b, c, d, e]) == [None, None, None, None, True]
+assert forced_values([a, b, d], assume=[b < 2]) == [9, 1, True]
+assert possible_values(c, assume=[c == 'y', d]) == set(['y'])
+assert forced_values(a, assume=[a < 7]) is None
+assert possible_values(a, assume=[a < 7]) is None
+assert solve()
+
+# queries don't add rules, and wide IntVars are decoded by bit
+reset()
+a = IntVar()
+b = OrderIntVar(1,5)
+c = BoolVar()
+require(a == 12345)
+require(b > 3)
+rules = len(claspy.rule_starts)
+assert forced_values([a, b, c]) == [12345, None, None]
+assert possible_values(b) == set([4, 5])
+assert len(claspy.rule_starts) == rules
+try:
+    possible_values(a)
+    assert False
+except ValueError:
+    pass
+
+######## Incremental solving ########
+
+reset()
+set_incremental()
+a = IntVar(0,3)
+b = IntVar(0,3)
+require(a + b == 3)
+num_solutions = 0
+while solve():
+    num_solutions += 1
+    require((a != a.value()) | (b != b.value()))
+assert num_solutions == 4
+
+# redefining a solved atom must not reuse old lemmas
+reset()
+x = BoolVar()
+p = Atom()
+p.prove_if(x)
+require(~x)
+solve()
+assert p.value() == False
+p.prove_if(True)
+require(p)
+assert solve()
+assert p.value() == True
+set_incremental(False)
+
+######## Streaming ########
+
+reset()
+set_streaming()
+claspy.ENCODE_CHUNK = 4  # stream the rules in several chunks
+a = IntVar(0,7)
+b = IntVar(0,7)
+require(a + b == 9)
+require(a > b)
+assert claspy.num_streamed > 0
+assert solve()
+assert a.value() + b.value() == 9 and a.value() > b.value()
+try:
+    solve()
+    assert False
+except RuntimeError:
+    pass
+
+reset()
+a = IntVar(0,7)
+b = IntVar(0,7)
+require(a + b == 9)
+assert sorted([a.value() for _ in iter_solutions(project=[a])]) == [2, 3, 4, 5, 6, 7]
+
+reset()
+a = IntVar(0,7)
+b = IntVar(0,7)
+require(a + b == 9)
+assert len(list(iter_solutions(limit=2, project=[a, b]))) == 2
+
+reset()
+a = IntVar(0,7)
+require(a > 7)
+assert not solve()
+claspy.ENCODE_CHUNK = 1 << 16
+set_streaming(False)
+
+######## Optimization ########
+
+reset()
+a = IntVar(0,7)
+b = DirectIntVar(0,7)
+c = OrderIntVar([1,3,8])
+require(a + b >= 9)
+require(c + a >= 9)
+minimize(a + b)
+maximize(c)
+found = []
+def improved(costs):
+    assert costs == objective_values()
+    found.append(costs)
+assert solve(callback=improved)
+assert claspy.optimal
+assert objective_values() == [9, 8] and found[-1] == [9, 8]
+assert a.value() + b.value() == 9 and c.value() == 8
+require(a < 2)
+assert not solve()
+assert not claspy.optimal
+
+# weighted booleans, with negative weights and constants
+reset()
+bools = [BoolVar() for i in range(4)]
+require(at_least(2, bools))
+minimize([(3, bools[0]), (1, bools[1]), (-2, ~bools[2]), (5, bools[3]), 10])
+assert solve()
+assert values(bools) == [False, True, True, False]
+assert objective_values() == [11]
+
+######## Assumptions ########
+
+reset()
+a = IntVar(0,7)
+b = IntVar(0,7)
+c = BoolVar()
+require(a + b == 7)
+require(c == (a > b))
+num_rules = len(claspy.rule_starts)
+assert solve(assume=[a == 2])
+assert values([a, b, c]) == [2, 5, False]
+assert solve(assume=[~c, b == 4])
+assert values([a, b, c]) == [3, 4, False]
+assert solve(assume=[c, True])
+assert a.value() > b.value()
+assert not solve(assume=[c, a < 3])
+assert not solve(assume=[False])
+assert solve()
+# only the assumed expressions added rules, and they were shared
+assert len(claspy.rule_starts) - num_rules <= 10
+
+# lemmas learned under assumptions aren't kept
+reset()
+set_incremental()
+a = IntVar(0,7)
+b = IntVar(0,7)
+require(a + b == 7)
+assert not solve(assume=[a == 2, b == 2])
+assert solve(assume=[a == 2])
+assert values([a, b]) == [2, 5]
+assert not claspy.session_lemmas
+assert solve()
+set_incremental(False)
+
+######## Parallel solving ########
+
+reset()
+a = IntVar(0,15)
+b = IntVar(0,15)
+require(a + b == 20)
+require(a > b)
+assert solve(threads=2)
+assert a.value() + b.value() == 20 and a.value() > b.value()
+assert solve(threads=2, mode='split')
+assert a.value() + b.value() == 20 and a.value() > b.value()
+assert solve(configs=['--configuration=frumpy', '--configuration=jumpy', '--seed=7'])
+assert a.value() + b.value() == 20 and a.value() > b.value()
+# a crashing config doesn't win the race
+assert solve(configs=['--no-such-option', '--configuration=jumpy'])
+assert a.value() + b.value() == 20 and a.value() > b.value()
+require(b > 10)
+assert not solve(configs=['--configuration=frumpy', '--configuration=jumpy'])
+
+# even when the program is too big to fit in the pipe before it crashes
+from cStringIO import StringIO
+reset()
+square = [[IntVar(1,15) for c in range(15)] for r in range(15)]
+for i in range(15):
+    require_all_diff(square[i])
+    require_all_diff([row[i] for row in square])
+program = StringIO()
+claspy.write_program(program)
+assert len(program.getvalue()) > 65536
+assert solve(configs=['--no-such-option', '--configuration=jumpy'])
+assert all(sorted(values(row)) == range(1,16) for row in square)
+assert not solve(configs=['--no-such-option', '--no-such-option'])
+try:
+    solve(threads=2, mode='race')
+    assert False
+except ValueError:
+    pass
+
+######## Timeouts and async solving ########
+
+def pigeons(n):
+    """n pigeons in n-1 holes, which is slow to prove unsatisfiable."""
+    p = [[BoolVar() for h in range(n - 1)] for i in range(n)]
+    for row in p:
+        require(any_of(row))
+    for h in range(n - 1):
+        require(at_most(1, [row[h] for row in p]))
+
+reset()
+pigeons(13)
+assert solve(timeout=0.5) is TIMEOUT
+assert not TIMEOUT
+run = solve_async()
+assert not run.done()
+run.cancel()
+assert run.result() == False
+
+reset()
+a = IntVar(0,7)
+require(a > 5)
+assert solve(timeout=30) == True
+run = solve_async(assume=[a == 6])
+assert run.wait(30)
+assert run.result() == True and a.value() == 6
+assert run.result() == True
+# a run that finished before its timer fired isn't a timeout
+run = solve_async(assume=[a == 7])
+assert run.wait(30)
+run.timed_out = True
+assert run.result() == True and a.value() == 7
+# a cancelled run doesn't change the solution
+run = solve_async(assume=[a == 6])
+assert run.wait(30)
+run.cancel()
+assert run.result() == False and a.value() == 7
+
+# several runs at once, in their own models
+runs = []
+for n in range(4):
+    with Model():
+        a = IntVar(0,7)
+        require(a == n)
+        runs.append((solve_async(), a))
+with Model():
+    pigeons(13)
+    slow = solve_async(timeout=60)
+finished = []
+for run in finished_runs(run for run, a in runs):
+    assert run.result() == True
+    finished.append(run)
+assert len(finished) == 4
+for n, (run, a) in enumerate(runs):
+    with run.model:
+        assert a.value() == n
+assert not slow.done()
+slow.cancel()
+assert slow.result() == False
+
+# the best solution so far is kept when optimizing
+reset()
+p = [[BoolVar() for h in range(12)] for i in range(13)]
+for row in p:
+    require(at_most(1, row))
+for h in range(12):
+    require(at_most(1, [row[h] for row in p]))
+maximize([any_of(row) for row in p])
+assert solve(timeout=1) == True
+assert objective_values() == [12] and not claspy.optimal
+
+######## Solve statistics ########
+
+reset()
+a = IntVar(0,15)
+b = IntVar(0,15)
+require(a * b == 35)
+assert solve()
+stats = claspy.solve_stats
+assert stats['result'] == 'SATISFIABLE'
+assert stats['rules'] == len(claspy.rule_starts)
+assert all(stats[phase] >= 0 for phase in claspy.SOLVE_PHASES)
+assert abs(stats['total'] - sum(stats[phase] for phase in claspy.SOLVE_PHASES)) < 1e-9
+assert stats['clasp_stats']['models'] == 1
+assert type(stats['clasp_stats']['conflicts']) is int
+assert 'time_solving' in stats['clasp_stats']
+require(a < 5)
+assert not solve()
+assert claspy.solve_stats['result'] == 'UNSATISFIABLE'
+assert claspy.solve_stats['clasp_stats']['models'] == 0
+assert claspy.parse_clasp_stats(['Conflicts    : 12  (Analyzed: 10)',
+                                 'Lemmas       : 3   (Deleted: 0)',
+                                 '  Binary     : 2   (Ratio:  66.67%)',
+                                 'Time         : 0.5s (Solving: 0.25s 1st Model: 0.01s)']) == \
+    {'conflicts': 12, 'conflicts_analyzed': 10, 'lemmas': 3, 'lemmas_deleted': 0,
+     'lemmas_binary': 2, 'lemmas_binary_ratio': 66.67, 'time': 0.5,
+     'time_solving': 0.25, 'time_1st_model': 0.01}
+
+######## Models ########
+
+reset()
+x = IntVar(0,7)
+require(x == 5)
+m = Model()
+with m:
+    y = IntVar(0,7)
+    require(y == 2)
+    assert solve()
+    assert y.value() == 2
+assert solve()
+assert x.value() == 5
+with m:
+    assert y.value() == 2
+    require(y > 2)
+    assert not solve()
+assert x.value() == 5
+
+# models built and solved from several threads
+import threading
+results = {}
+def build_and_solve(n):
+    with Model():
+        a = IntVar(0,15)
+        b = IntVar(0,15)
+        require(a + b == n)
+        require(a == b)
+        solve()
+        results[n] = a.value()
+threads = [threading.Thread(target=build_and_solve, args=(2*n,)) for n in range(6)]
+for t in threads: t.start()
+for t in threads: t.join()
+assert results == dict((2*n, n) for n in range(6))
+
+# two threads take turns in their models, and the default model is kept
+reset()
+x = IntVar(0,7)
+require(x == 3)
+rules = len(claspy.rule_starts)
+results = {}
+def add_and_solve(n):
+    m = Model()
+    for i in range(5):
+        with m:
+            if i == 0:
+                a = IntVar(0,15)
+                require(a >= n)
+                require(a <= n + 5)
+            require(a != n + i)
+            solve()
+            results[n] = a.value()
+threads = [threading.Thread(target=add_and_solve, args=(n,)) for n in (0, 8)]
+for t in threads: t.start()
+for t in threads: t.join()
+assert results == {0: 5, 8: 13}
+assert len(claspy.rule_starts) == rules
+assert solve() and x.value() == 3
+
+# a thread can only be inside one model at a time
+m1 = Model()
+m2 = Model()
+with m1:
+    try:
+        with m2:
+            pass
+        assert False
+    except RuntimeError:
+        pass
+    a = IntVar(0,3)
+with m2:
+    assert claspy.active_model is m2
+
+# the default model can't be used while another thread is inside a model
+entered = threading.Event()
+leave = threading.Event()
+def stay_in_model():
+    with Model():
+        entered.set()
+        leave.wait(30)
+t = threading.Thread(target=stay_in_model)
+t.start()
+entered.wait(30)
+try:
+    BoolVar()
+    assert False
+except RuntimeError:
+    pass
+leave.set()
+t.join()
+assert solve() and x.value() == 3
+
+# the model is left while solutions are read, so other threads can solve
+first = threading.Event()
+finished = []
+def optimize():
+    with Model():
+        p = [[BoolVar() for h in range(12)] for i in range(13)]
+        for row in p:
+            require(at_most(1, row))
+        for h in range(12):
+            require(at_most(1, [row[h] for row in p]))
+        maximize([any_of(row) for row in p])
+        solve(timeout=2, callback=lambda values: first.set())
+        finished.append('optimize')
+t = threading.Thread(target=optimize)
+t.start()
+assert first.wait(30)
+with Model():
+    a = IntVar(0,7)
+    require(a == 6)
+    assert solve()
+    finished.append('other')
+t.join()
+assert finished == ['other', 'optimize']
+
+######## Batch solving ########
+
+import os
+
+def build_half(n):
+    if n < 0:
+        raise ValueError('negative sum')
+    a = IntVar(0,15)
+    b = IntVar(0,15)
+    require(a + b == n)
+    require(a == b)
+    return a
+found = {}
+for i, value, seconds, error in solve_many(build_half, [4, 3, -2, 10, 0], workers=2):
+    assert seconds >= 0
+    found[i] = (value, error is None)
+assert found == {0: (2, True), 1: (None, True), 2: (None, False),
+                 3: (5, True), 4: (0, True)}
+
+# an instance whose worker dies fails, and the others still finish
+def build_or_exit(n):
+    if n == 0:
+        os._exit(1)
+    return build_half(n)
+found = {}
+for i, value, seconds, error in solve_many(build_or_exit, [4, 0, 6], workers=2):
+    found[i] = (value, error)
+assert found == {0: (2, None), 1: (None, 'The worker process died.'), 2: (3, None)}
+
+# even if it is killed before it starts the instance
+import signal
+class KillOnLoad(object):
+    def __setstate__(self, state):
+        os.kill(os.getpid(), signal.SIGKILL)
+found = {}
+for i, value, seconds, error in solve_many(build_half, [4, KillOnLoad(), 6], workers=1):
+    found[i] = (value, error)
+assert found == {0: (2, None), 1: (None, 'The worker process died.'), 2: (3, None)}
+
+######## Program caching ########
+
+import shutil, tempfile
+program_file = os.path.join(tempfile.mkdtemp(), 'program')
+reset()
+a = IntVar(0,15)
+b = DirectIntVar(0,7)
+c = MultiVar('x','y','z')
+d = BoolVar()
+require(a == b + 5)
+require(c != 'x')
+require(d == (c == 'y'))
+num_literals = claspy.last_bool
+num_rules = len(claspy.rule_starts)
+save_program(program_file, [a, b, c, d])
+reset()
+a, b, c, d = load_program(program_file)
+assert claspy.last_bool == num_literals
+assert len(claspy.rule_starts) == num_rules
+require(b > 5)
+require(~d)
+assert solve()
+assert a.value() == b.value() + 5 and b.value() > 5
+assert c.value() == 'z' and d.value() == False
+require(c == 'x')
+assert not solve()
+shutil.rmtree(os.path.dirname(program_file))
+
+claspy.CACHE_DIR = os.path.join(tempfile.mkdtemp(), 'cache')
+built = []
+def build_product(n):
+    built.append(n)
+    a = IntVar(2,15)
+    b = IntVar(2,15)
+    require(a * b == n)
+    require(a <= b)
+    return [a, b]
+for _ in range(2):
+    a, b = cached_program(build_product, (35,))
+    assert solve() and values([a, b]) == [5, 7]
+assert built == [35]
+a, b = cached_program(build_product, (77,), key='product')
+assert solve() and values([a, b]) == [7, 11]
+a, b = cached_program(build_product, (35,), key='product')
+assert solve() and values([a, b]) == [7, 11]
+assert built == [35, 77]
+assert os.stat(claspy.CACHE_DIR).st_mode & 0777 == 0700
+# a file that can't be loaded is built again
+for name in os.listdir(claspy.CACHE_DIR):
+    with open(os.path.join(claspy.CACHE_DIR, name), 'r+b') as f:
+        f.truncate(100)
+a, b = cached_program(build_product, (35,))
+assert solve() and values([a, b]) == [5, 7]
+assert built == [35, 77, 35]
+# so is a program from an edited builder
+def build_product(n):
+    built.append(-n)
+    a = IntVar(2,15)
+    b = IntVar(2,15)
+    require(a * b == n)
+    require(a > b)
+    return [a, b]
+a, b = cached_program(build_product, (35,))
+assert solve() and values([a, b]) == [7, 5]
+assert built == [35, 77, 35, -35]
+# or from an edited helper, or a changed constant
+MAX_FACTOR = 15
+def order_factors(a, b):
+    require(a < b)
+def build_factors(n):
+    built.append(n)
+    a = IntVar(2,MAX_FACTOR)
+    b = IntVar(2,MAX_FACTOR)
+    require(a * b == n)
+    order_factors(a, b)
+    return [a, b]
+built = []
+for _ in range(2):
+    a, b = cached_program(build_factors, (35,))
+    assert solve() and values([a, b]) == [5, 7]
+def order_factors(a, b):
+    require(a > b)
+a, b = cached_program(build_factors, (35,))
+assert solve() and values([a, b]) == [7, 5]
+MAX_FACTOR = 6
+a, b = cached_program(build_factors, (35,))
+assert not solve()
+assert built == [35, 35, 35]
+# a builder with other values in its closure needs a key
+def make_builder(factors):
+    def build(n):
+        a = IntVar(2,15)
+        require(a == factors[0])
+        return a
+    return build
+try:
+    cached_program(make_builder([5]), (35,))
+    assert False
+except TypeError:
+    pass
+a = cached_program(make_builder([5]), (35,), key='five')
+assert solve() and a.value() == 5
+shutil.rmtree(os.path.dirname(claspy.CACHE_DIR))
+
+######## IntVar widths ########
+
+reset()
+assert len(IntVar().bits) == 16
+assert len(IntVar(1,9).bits) == 4
+assert len(IntVar(0,1).bits) == 1
+assert len(IntVar(5).bits) == 3
+assert len(IntVar(0).bits) == 1
+assert len(IntVar([2,3,17]).bits) == 5
+a = IntVar(1,9)
+b = IntVar(1,9)
+assert len((a + b).bits) == 5
+assert (a + b).max_val == 18
+assert (a - b).max_val == 9
+assert len((a << 2).bits) == 6
+assert len((a >> 2).bits) == 2
+require(a + b == 18)
+solve()
+assert a.value() == 9
+assert b.value() == 9
+
+# ranges wider than the default number of bits
+reset()
+a = IntVar(0, 100000)
+assert len(a.bits) == 17
+require(a > 70000)
+require(a < 70002)
+solve()
+assert a.value() == 70001
+
+# mixed widths
+reset()
+a = IntVar(0,3)
+b = IntVar()
+c = a * b
+require(b == 1000)
+require(a == 3)
+require(c - a == 2997)
+solve()
+assert c.value() == 3000
+
+# overflows beyond the default width are forbidden
+reset()
+set_bits(4)
+a = IntVar()
+b = IntVar()
+require(a + b > 14)
+solve()
+assert a.value() + b.value() == 15
+
+
+######## Direct and order ints ########
+
+for cls in [DirectIntVar, OrderIntVar]:
+    reset()
+    a = cls(1,9)
+    require(a > 3)
+    require(a < 5)
+    solve()
+    assert a.value() == 4
+
+    reset()
+    a = cls([2,5,7])
+    b = cls(0,6)
+    require(a == b)
+    require(a != 2)
+    solve()
+    assert a.value() == 5
+    assert b.value() == 5
+    assert values([a, b]) == [5, 5]
+
+    # mixed with binary IntVars
+    reset()
+    a = cls(1,9)
+    b = IntVar()
+    c = a + b
+    require(c == 20)
+    require(b == a * 2 + 2)
+    solve()
+    assert (a.value(), b.value(), c.value()) == (6, 14, 20)
+
+    reset()
+    a = cls(3,5)
+    x = BoolVar()
+    c = cond(x, a, 8)
+    require(c == 4)
+    solve()
+    assert x.value() == True
+    assert a.value() == 4
+
+    reset()
+    a = cls(0,3)
+    require(a >= 1)
+    assert sorted([a.value() for _ in iter_solutions()]) == [1, 2, 3]
+
+# comparisons with constants don't need a binary encoding
+reset()
+a = DirectIntVar(1,9)
+b = OrderIntVar(1,9)
+rules = len(claspy.rule_starts)
+require(a == 4)
+require(b >= 3)
+require(b <= 6)
+assert len(claspy.rule_starts) - rules == 3
+
+# comparisons between the two encodings
+reset()
+a = DirectIntVar(1,9)
+b = OrderIntVar(1,9)
+require(a < b)
+require(b < 3)
+require(~(a > b))
+solve()
+assert (a.value(), b.value()) == (1, 2)
+
+# a domain is needed
+for cls in (DirectIntVar, OrderIntVar):
+    try:
+        cls()
+        assert False
+    except TypeError:
+        pass
+
+######## Linear constraints ########
+
+reset()
+a = IntVar(0,10)
+b = BoolVar()
+c = DirectIntVar([0,5])
+d = OrderIntVar(2,4)
+require(linear_eq([3, -4, 2, 1], [a, b, c, d], 27))
+require(linear_le([1, 1], [a, c], 12))
+require(linear_ge([2], [d], 7))
+solve()
+assert (a.value(), b.value(), c.value(), d.value()) == (9, True, 0, 4)
+
+reset()
+xs = [IntVar(0,9) for i in range(5)]
+s = sum_vars(xs)
+rules = len(claspy.rule_starts)
+require(s == 40)
+require(s > xs[4])
+assert len(claspy.rule_starts) - rules <= 8
+require(xs[0] > xs[1])
+solve()
+assert sum(values(xs)) == 40
+assert s.value() == 40
+assert xs[0].value() > xs[1].value()
+
+# sums used in arithmetic are built with adders
+reset()
+xs = [BoolVar() for i in range(4)]
+s = sum_vars(xs) + 1
+t = s * 2
+require(t == 6)
+require(xs[3])
+solve()
+assert s.value() == 3
+assert t.value() == 6
+assert sum(values(xs)) == 2
+
+reset()
+assert linear_ge([1, 1], [BoolVar(), BoolVar()], 3).index == FALSE_BOOL.index
+assert linear_le([1, 1], [BoolVar(), BoolVar()], 2).index == TRUE_BOOL.index
+
+######## Counting ########
+
+reset()
+xs = [BoolVar() for i in range(7)]
+n = count(xs)
+assert count(xs) is n
+assert (count(xs) >= 3).index == (n >= 3).index
+rules = len(claspy.rule_starts)
+require(n >= 2)
+require(n <= 3)
+require(n != 2)
+require(~xs[0] & ~xs[1])
+assert len(claspy.rule_starts) - rules == 6
+solve()
+assert n.value() == 3
+assert sum(values(xs)) == 3
+
+# conversion to other IntVars
+reset()
+xs = [BoolVar() for i in range(5)]
+y = IntVar(0,9)
+require(count(xs) * 2 == y)
+require(y > 7)
+solve()
+assert y.value() == 8
+assert count(xs).value() == 4
+assert sum(values(xs)) == 4
+
+reset()
+xs = [BoolVar() for i in range(6)]
+require(count(xs) == 2)
+assert len(list(iter_solutions())) == 15
 
 print 'ALL TESTS PASSED'